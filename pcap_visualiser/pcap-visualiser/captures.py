@@ -0,0 +1,56 @@
+import sqlite3
+import time
+import uuid
+
+CAPTURES_DB = 'captures.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    path TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+# Uploaded captures that graphs can be requested for one at a time. Only
+# where the capture is stored and how it is analysed is kept here; analyses
+# and graphs live in the result and render caches.
+class CaptureStore:
+    def __init__(self, path=CAPTURES_DB):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def add(self, filename, path, digest, engine):
+        capture_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO captures (id, filename, path, digest, engine, created) VALUES (?, ?, ?, ?, ?, ?)',
+                (capture_id, filename, path, digest, engine, time.time()),
+            )
+        return capture_id
+
+    def get(self, capture_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT filename, path, digest, engine, created FROM captures WHERE id = ?', (capture_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        filename, path, digest, engine, created = row
+        return {
+            'captureId': capture_id,
+            'filename': filename,
+            'path': path,
+            'digest': digest,
+            'engine': engine,
+            'created': created,
+        }
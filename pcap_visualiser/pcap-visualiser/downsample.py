@@ -0,0 +1,83 @@
+import numpy as np
+
+# Reduce long time series to a bounded number of points before they are
+# plotted or sent to the front end.
+#
+# "lttb"   Largest-Triangle-Three-Buckets: keeps the visual shape of the
+#          series, including isolated spikes, with exactly max_points points.
+# "minmax" Splits the x range into max_points / 2 equal-width buckets (one per
+#          pixel column) and keeps the lowest and highest point of each, so
+#          no extreme value is ever dropped.
+# "none"   Keeps every point.
+DOWNSAMPLE_MODES = ('lttb', 'minmax', 'none')
+
+
+def lttb(x, y, max_points):
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return x, y
+
+    # First and last points are always kept; the rest is split into
+    # max_points - 2 buckets of (almost) equal size
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket is the third triangle corner
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+
+        bucket_x = x[start:end]
+        bucket_y = y[start:end]
+        areas = np.abs((x[a] - avg_x) * (bucket_y - y[a]) - (x[a] - bucket_x) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+
+    return x[selected], y[selected]
+
+
+def minmax(x, y, max_points):
+    n = len(x)
+    if max_points >= n or max_points < 2:
+        return x, y
+
+    buckets = max(1, max_points // 2)
+    edges = np.linspace(x[0], x[-1], buckets + 1)
+    bucket_ids = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, buckets - 1)
+
+    # x is sorted, so each bucket is a contiguous run of points
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket_ids)) + 1))
+    counts = np.diff(np.append(starts, n))
+    segment = np.repeat(np.arange(len(starts)), counts)
+
+    picked = []
+    for reduce in (np.minimum, np.maximum):
+        extremes = np.repeat(reduce.reduceat(y, starts), counts)
+        hits = np.flatnonzero(y == extremes)
+        _, first = np.unique(segment[hits], return_index=True)
+        picked.append(hits[first])
+
+    selected = np.unique(np.concatenate(picked))
+    return x[selected], y[selected]
+
+
+# Downsample (x, y) to at most max_points points with the given mode. x must
+# be sorted in ascending order.
+def downsample(x, y, max_points, mode='lttb'):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if mode == 'none' or not max_points or len(x) <= max_points:
+        return x, y
+    if mode == 'lttb':
+        return lttb(x, y, max_points)
+    if mode == 'minmax':
+        return minmax(x, y, max_points)
+    raise ValueError(f"Unknown downsample mode: {mode}")
@@ -0,0 +1,209 @@
+import numpy as np
+
+# Per-flow metrics keyed on the 5-tuple (addresses, ports and transport).
+# Both directions of a conversation are one flow: packets are grouped on
+# their two (address, port) endpoints in sorted order, so A->B and B->A share
+# a key. A flow that sees no packet for idle_timeout seconds is evicted, the
+# way a router's flow cache would, and a later packet with the same 5-tuple
+# starts a new flow.
+#
+# Every flow is a fixed-size row of running state (first/last seen, bytes,
+# packets, inter-arrival statistics) in one structured array, computed from
+# the packet table in a single sorted pass rather than by collecting the
+# timestamps of each flow.
+
+DEFAULT_IDLE_TIMEOUT = 120.0
+MIN_IDLE_TIMEOUT = 0.001
+MAX_IDLE_TIMEOUT = 86400.0
+
+# One row per flow, oriented from the initiator (the sender of the flow's
+# first packet). fwd_* count the initiator's direction only. Inter-arrival
+# statistics are over the gaps between consecutive packets of the flow and
+# are NaN for single-packet flows.
+FLOW_DTYPE = np.dtype([
+    ('src', '<u4'),
+    ('dst', '<u4'),
+    ('sport', '<u2'),
+    ('dport', '<u2'),
+    ('transport', '<u2'),
+    ('first', '<f8'),
+    ('last', '<f8'),
+    ('bytes', '<u8'),
+    ('packets', '<u4'),
+    ('fwd_bytes', '<u8'),
+    ('fwd_packets', '<u4'),
+    ('gap_mean', '<f8'),
+    ('gap_std', '<f8'),
+    ('gap_min', '<f8'),
+    ('gap_max', '<f8'),
+])
+
+# Orderings accepted by FlowTable.records
+FLOW_SORT_KEYS = ('bytes', 'packets', 'duration', 'bandwidth', 'first')
+
+
+# Integer key of a 5-tuple, the same whichever way round the endpoints are
+# given. Addresses are table ids, so the key fits in one Python int.
+def flow_key(src, sport, dst, dport, transport):
+    low, high = sorted((src << 16 | sport, dst << 16 | dport))
+    return low << 64 | high << 16 | transport
+
+
+def _endpoints(addresses, ports):
+    return addresses.astype(np.uint64) << np.uint64(16) | ports.astype(np.uint64)
+
+
+def _rounded(value, digits=6):
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+class FlowTable:
+    def __init__(self, flows, protocols, addresses):
+        self.flows = flows
+        self.protocols = protocols
+        self.addresses = addresses
+        self._index = None
+        self._address_ids = None
+
+    def __len__(self):
+        return len(self.flows)
+
+    @property
+    def durations(self):
+        return self.flows['last'] - self.flows['first']
+
+    # Bytes per second over each flow's lifetime, NaN for flows that lasted
+    # no time at all
+    @property
+    def bandwidths(self):
+        durations = self.durations
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(durations > 0, self.flows['bytes'] / durations, np.nan)
+
+    # Hash index from flow_key to the rows of every flow with that 5-tuple,
+    # oldest first, built on first lookup
+    def index(self):
+        if self._index is None:
+            index = {}
+            flows = self.flows
+            for row, key in enumerate(map(flow_key, flows['src'].tolist(), flows['sport'].tolist(),
+                                          flows['dst'].tolist(), flows['dport'].tolist(),
+                                          flows['transport'].tolist())):
+                index.setdefault(key, []).append(row)
+            self._index = index
+        return self._index
+
+    # Rows of the flows between two endpoints over a transport, given by
+    # address text and protocol name, in either direction
+    def find(self, src, sport, dst, dport, transport):
+        if self._address_ids is None:
+            self._address_ids = {address: aid for aid, address in enumerate(self.addresses)}
+        src_id = self._address_ids.get(src)
+        dst_id = self._address_ids.get(dst)
+        if src_id is None or dst_id is None or transport not in self.protocols:
+            return []
+        return self.index().get(flow_key(src_id, sport, dst_id, dport, self.protocols.index(transport)), [])
+
+    # JSON form of a flow
+    def record(self, row):
+        flow = self.flows[row]
+        duration = float(flow['last'] - flow['first'])
+        return {
+            'src': self.addresses[flow['src']],
+            'sport': int(flow['sport']),
+            'dst': self.addresses[flow['dst']],
+            'dport': int(flow['dport']),
+            'transport': self.protocols[flow['transport']],
+            'start': float(flow['first']),
+            'end': float(flow['last']),
+            'duration': round(duration, 6),
+            'bytes': int(flow['bytes']),
+            'packets': int(flow['packets']),
+            'bandwidth': round(int(flow['bytes']) / duration, 3) if duration > 0 else None,
+            'forwardBytes': int(flow['fwd_bytes']),
+            'forwardPackets': int(flow['fwd_packets']),
+            'interArrival': {
+                'mean': _rounded(flow['gap_mean']),
+                'std': _rounded(flow['gap_std']),
+                'min': _rounded(flow['gap_min']),
+                'max': _rounded(flow['gap_max']),
+            },
+        }
+
+    # JSON form of the flows in `rows` (all of them if None), largest first
+    # by `sort`, or in start order for 'first'
+    def records(self, sort='bytes', limit=None, rows=None):
+        if sort not in FLOW_SORT_KEYS:
+            raise ValueError(f"Unknown flow ordering, expected one of {', '.join(FLOW_SORT_KEYS)}")
+        rows = np.arange(len(self.flows)) if rows is None else np.asarray(rows, dtype=np.int64)
+        if sort == 'first':
+            values = self.flows['first'][rows]
+        elif sort == 'duration':
+            values = -self.durations[rows]
+        elif sort == 'bandwidth':
+            values = -np.nan_to_num(self.bandwidths[rows], nan=-1.0)
+        else:
+            values = -self.flows[sort][rows].astype(np.float64)
+        rows = rows[np.argsort(values, kind='stable')]
+        if limit is not None:
+            rows = rows[:limit]
+        return [self.record(row) for row in rows.tolist()]
+
+
+# Group a packet table into flows. Packets without both IP addresses (ARP,
+# truncated frames) belong to no flow unless ip_only is False.
+def build_flows(table, idle_timeout=DEFAULT_IDLE_TIMEOUT, ip_only=True):
+    packets = table.packets
+    if ip_only:
+        packets = packets[(packets['src'] != 0) & (packets['dst'] != 0)]
+    count = len(packets)
+    if count == 0:
+        return FlowTable(np.empty(0, dtype=FLOW_DTYPE), table.protocols, table.addresses)
+
+    src_endpoints = _endpoints(packets['src'], packets['sport'])
+    dst_endpoints = _endpoints(packets['dst'], packets['dport'])
+    low = np.minimum(src_endpoints, dst_endpoints)
+    high = np.maximum(src_endpoints, dst_endpoints)
+    order = np.lexsort((packets['timestamp'], packets['transport'], high, low))
+    packets = packets[order]
+    low, high, src_endpoints = low[order], high[order], src_endpoints[order]
+    timestamps = packets['timestamp']
+    lengths = packets['length'].astype(np.uint64)
+
+    # A flow starts at the first packet of each 5-tuple and after every idle gap
+    gaps = np.diff(timestamps, prepend=timestamps[0])
+    new_flow = np.empty(count, dtype=bool)
+    new_flow[0] = True
+    new_flow[1:] = ((low[1:] != low[:-1]) | (high[1:] != high[:-1])
+                    | (packets['transport'][1:] != packets['transport'][:-1]) | (gaps[1:] > idle_timeout))
+    starts = np.flatnonzero(new_flow)
+    ends = np.append(starts[1:], count) - 1
+    flow_packets = ends - starts + 1
+    gaps[new_flow] = 0.0
+
+    forward = src_endpoints == np.repeat(src_endpoints[starts], flow_packets)
+    gap_counts = flow_packets - 1
+    first = timestamps[starts]
+    last = timestamps[ends]
+
+    flows = np.empty(len(starts), dtype=FLOW_DTYPE)
+    for column in ('src', 'dst', 'sport', 'dport', 'transport'):
+        flows[column] = packets[column][starts]
+    flows['first'] = first
+    flows['last'] = last
+    flows['bytes'] = np.add.reduceat(lengths, starts)
+    flows['packets'] = flow_packets
+    flows['fwd_bytes'] = np.add.reduceat(np.where(forward, lengths, np.uint64(0)), starts)
+    flows['fwd_packets'] = np.add.reduceat(forward.astype(np.uint32), starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(gap_counts > 0, (last - first) / gap_counts, np.nan)
+        mean_square = np.where(gap_counts > 0, np.add.reduceat(gaps * gaps, starts) / gap_counts, np.nan)
+    flows['gap_mean'] = mean
+    flows['gap_std'] = np.sqrt(np.maximum(mean_square - mean * mean, 0.0))
+    gap_min = np.minimum.reduceat(np.where(new_flow, np.inf, gaps), starts)
+    gap_max = np.maximum.reduceat(np.where(new_flow, -np.inf, gaps), starts)
+    flows['gap_min'] = np.where(gap_counts > 0, gap_min, np.nan)
+    flows['gap_max'] = np.where(gap_counts > 0, gap_max, np.nan)
+
+    flows = flows[np.argsort(flows['first'], kind='stable')]
+    return FlowTable(flows, table.protocols, table.addresses)
@@ -0,0 +1,28 @@
+# gunicorn -c gunicorn.conf.py server:app
+#
+# The app is imported once in the master, warmed up there and then forked,
+# so workers start with pyshark, pandas, seaborn, matplotlib and the font
+# cache already loaded and share those pages copy-on-write. Process pools and
+# job threads are only started inside each worker, after the fork.
+import multiprocessing
+import os
+
+bind = '0.0.0.0:5001'
+workers = max(2, min(4, multiprocessing.cpu_count()))
+preload_app = True
+timeout = 300
+
+
+def on_starting(server):
+    # Workers size their parse pools by how many of them share the machine
+    from parallel_parse import SERVER_PROCESSES_ENV
+    os.environ[SERVER_PROCESSES_ENV] = str(server.cfg.workers)
+    from warmup import warm_up
+    warm_up(freeze=True)
+
+
+def post_fork(server, worker):
+    from render import warm_render_pool
+    from server import job_runner
+    warm_render_pool()
+    job_runner.start()
@@ -0,0 +1,214 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+JOBS_DB = 'jobs.db'
+
+# Worker threads pulling jobs off the queue in each server process
+JOB_WORKERS = 2
+
+# A running job whose heartbeat is older than this is assumed to belong to
+# a process that died and is put back on the queue
+JOB_STALE_SECONDS = 60
+HEARTBEAT_SECONDS = 10
+POLL_SECONDS = 1
+
+# Progress is written at most this often per capture while parsing
+PROGRESS_INTERVAL_SECONDS = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_progress (
+    job_id TEXT NOT NULL,
+    capture TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    packets INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, capture)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+"""
+
+
+class JobError(Exception):
+    pass
+
+
+# Persistent job queue in SQLite, safe to share between threads and processes
+class JobStore:
+    def __init__(self, path=JOBS_DB):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def submit(self, params):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, status, params, created, updated) VALUES (?, ?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(params), now, now),
+            )
+        return job_id
+
+    # Atomically move the oldest queued (or abandoned) job to running
+    def claim(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT id, params FROM jobs WHERE status = 'queued' OR (status = 'running' AND updated < ?) "
+                "ORDER BY created LIMIT 1",
+                (now - JOB_STALE_SECONDS,),
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (now, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, job_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def set_progress(self, job_id, capture, stage, packets=None):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO job_progress (job_id, capture, stage, packets) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (job_id, capture) DO UPDATE SET stage = excluded.stage, '
+                'packets = COALESCE(?, job_progress.packets)',
+                (job_id, capture, stage, packets or 0, packets),
+            )
+            conn.execute('UPDATE jobs SET updated = ? WHERE id = ?', (time.time(), job_id))
+
+    def finish(self, job_id, result):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, updated = ? WHERE id = ?",
+                (json.dumps(result), time.time(), job_id),
+            )
+
+    def fail(self, job_id, error):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                (error, time.time(), job_id),
+            )
+
+    def status(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT status, error, created, updated FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            progress = conn.execute(
+                'SELECT capture, stage, packets FROM job_progress WHERE job_id = ? ORDER BY capture', (job_id,)
+            ).fetchall()
+        return {
+            'jobId': job_id,
+            'status': row[0],
+            'error': row[1],
+            'created': row[2],
+            'updated': row[3],
+            'captures': {capture: {'stage': stage, 'packetsProcessed': packets} for capture, stage, packets in progress},
+            'packetsProcessed': sum(packets for _, _, packets in progress),
+        }
+
+    def result(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT status, result, error FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, result, error = row
+        return status, json.loads(result) if result else None, error
+
+
+# Picklable progress callback handed to worker processes. Records the stage
+# of one capture and, while parsing, the number of packets processed so far.
+class JobProgress:
+    def __init__(self, db_path, job_id, capture):
+        self.db_path = db_path
+        self.job_id = job_id
+        self.capture = capture
+        self._last = 0.0
+
+    def __call__(self, stage, packets=None):
+        now = time.time()
+        if stage == 'parsing' and packets and now - self._last < PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last = now
+        JobStore(self.db_path).set_progress(self.job_id, self.capture, stage, packets)
+
+    def __getstate__(self):
+        return {'db_path': self.db_path, 'job_id': self.job_id, 'capture': self.capture}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._last = 0.0
+
+
+# Bounded pool of threads that run queued jobs through `execute(job_id,
+# params, heartbeat)`, which returns the job result or raises JobError
+class JobRunner:
+    def __init__(self, store, execute, workers=JOB_WORKERS):
+        self.store = store
+        self.execute = execute
+        self.workers = workers
+        self._threads = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def notify(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            claimed = self.store.claim()
+            if claimed is None:
+                self._wake.wait(POLL_SECONDS)
+                self._wake.clear()
+                continue
+            job_id, params = claimed
+            print(f"Running job {job_id}")
+            try:
+                result = self.execute(job_id, params, lambda: self.store.heartbeat(job_id))
+            except JobError as e:
+                print(f"Job {job_id} failed: {e}")
+                self.store.fail(job_id, str(e))
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                self.store.fail(job_id, "Error processing pcap files")
+            else:
+                self.store.finish(job_id, result)
+                print(f"Job {job_id} finished")
@@ -0,0 +1,201 @@
+from array import array
+import ipaddress
+import numpy as np
+from pcap_reader import IPV6_TAG, NO_MATCH, decode_packet, link_name
+
+# One row per packet. Protocol and address columns hold ids into the
+# table's `protocols` and `addresses` lists; id 0 means "none". The link,
+# network, transport and application columns form the packet's protocol
+# stack. flags/seq/ack/payload are the request/response matching fields
+# described at pcap_reader.NO_MATCH.
+PACKET_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('length', '<u4'),
+    ('link', '<u2'),
+    ('network', '<u2'),
+    ('transport', '<u2'),
+    ('application', '<u2'),
+    ('src', '<u4'),
+    ('dst', '<u4'),
+    ('sport', '<u2'),
+    ('dport', '<u2'),
+    ('flags', 'u1'),
+    ('seq', '<u4'),
+    ('ack', '<u4'),
+    ('payload', '<u2'),
+])
+
+
+# How often long-running parses report progress
+PROGRESS_PACKETS = 65536
+
+
+# Render an address key as text. Keys are either strings (pyshark) or
+# integers from pcap_reader.decode_packet.
+def format_address(key):
+    if isinstance(key, str):
+        return key
+    if key & IPV6_TAG:
+        return str(ipaddress.IPv6Address(key ^ IPV6_TAG))
+    return str(ipaddress.IPv4Address(key))
+
+
+class PacketTable:
+    def __init__(self, packets, protocols, addresses):
+        self.packets = packets
+        self.protocols = protocols
+        self.addresses = addresses
+
+    def __len__(self):
+        return len(self.packets)
+
+    @property
+    def timestamps(self):
+        return self.packets['timestamp']
+
+    @property
+    def lengths(self):
+        return self.packets['length']
+
+    def protocol_id(self, name):
+        try:
+            return self.protocols.index(name)
+        except ValueError:
+            return -1
+
+
+# Accumulates rows in typed arrays while a capture is being read
+class PacketTableBuilder:
+    def __init__(self):
+        self._timestamp = array('d')
+        self._length = array('I')
+        self._link = array('H')
+        self._network = array('H')
+        self._transport = array('H')
+        self._application = array('H')
+        self._src = array('I')
+        self._dst = array('I')
+        self._sport = array('H')
+        self._dport = array('H')
+        self._flags = array('B')
+        self._seq = array('I')
+        self._ack = array('I')
+        self._payload = array('H')
+        self._protocol_ids = {None: 0}
+        self._protocols = ['']
+        self._address_ids = {None: 0}
+        self._address_keys = [None]
+
+    def __len__(self):
+        return len(self._timestamp)
+
+    def _protocol(self, name):
+        pid = self._protocol_ids.get(name)
+        if pid is None:
+            pid = self._protocol_ids[name] = len(self._protocols)
+            self._protocols.append(name)
+        return pid
+
+    def _address(self, key):
+        aid = self._address_ids.get(key)
+        if aid is None:
+            aid = self._address_ids[key] = len(self._address_keys)
+            self._address_keys.append(key)
+        return aid
+
+    def add(self, timestamp, length, transport, application, src, dst, sport, dport, link=None, network=None, match=NO_MATCH):
+        self._timestamp.append(timestamp)
+        self._length.append(length)
+        self._link.append(self._protocol(link))
+        self._network.append(self._protocol(network))
+        self._transport.append(self._protocol(transport))
+        self._application.append(self._protocol(application))
+        self._src.append(self._address(src))
+        self._dst.append(self._address(dst))
+        self._sport.append(sport)
+        self._dport.append(dport)
+        flags, seq, ack, payload = match
+        self._flags.append(flags)
+        self._seq.append(seq)
+        self._ack.append(ack)
+        self._payload.append(payload)
+
+    # Decode and add (timestamp, caplen, wirelen, linktype, buf, offset)
+    # records as produced by pcap_reader. progress('parsing', packets) is
+    # called every PROGRESS_PACKETS packets if given.
+    def add_records(self, records, progress=None):
+        add = self.add
+        links = {}
+        for timestamp, caplen, size, linktype, buf, offset in records:
+            network, trans_proto, app_proto, src, dst, sport, dport, match = decode_packet(buf, offset, caplen, linktype)
+            link = links.get(linktype)
+            if link is None:
+                link = links[linktype] = link_name(linktype)
+            add(timestamp, size, trans_proto, app_proto, src, dst, sport, dport, link, network, match)
+            if progress is not None and len(self._timestamp) % PROGRESS_PACKETS == 0:
+                progress('parsing', len(self._timestamp))
+
+    def build(self):
+        packets = np.empty(len(self._timestamp), dtype=PACKET_DTYPE)
+        packets['timestamp'] = np.frombuffer(self._timestamp, dtype=np.float64)
+        packets['length'] = np.frombuffer(self._length, dtype=np.uint32)
+        packets['link'] = np.frombuffer(self._link, dtype=np.uint16)
+        packets['network'] = np.frombuffer(self._network, dtype=np.uint16)
+        packets['transport'] = np.frombuffer(self._transport, dtype=np.uint16)
+        packets['application'] = np.frombuffer(self._application, dtype=np.uint16)
+        packets['src'] = np.frombuffer(self._src, dtype=np.uint32)
+        packets['dst'] = np.frombuffer(self._dst, dtype=np.uint32)
+        packets['sport'] = np.frombuffer(self._sport, dtype=np.uint16)
+        packets['dport'] = np.frombuffer(self._dport, dtype=np.uint16)
+        packets['flags'] = np.frombuffer(self._flags, dtype=np.uint8)
+        packets['seq'] = np.frombuffer(self._seq, dtype=np.uint32)
+        packets['ack'] = np.frombuffer(self._ack, dtype=np.uint32)
+        packets['payload'] = np.frombuffer(self._payload, dtype=np.uint16)
+        addresses = [''] + [format_address(key) for key in self._address_keys[1:]]
+        return PacketTable(packets, list(self._protocols), addresses)
+
+
+# Decode (timestamp, caplen, wirelen, linktype, buf, offset) records from
+# pcap_reader into a table
+def table_from_records(records, progress=None):
+    builder = PacketTableBuilder()
+    builder.add_records(records, progress)
+    return builder.build()
+
+
+# Re-intern ids so that `names` from one table index into `merged`
+def _remap(names, merged, merged_ids):
+    mapping = np.empty(len(names), dtype=np.uint32)
+    for i, name in enumerate(names):
+        mid = merged_ids.get(name)
+        if mid is None:
+            mid = merged_ids[name] = len(merged)
+            merged.append(name)
+        mapping[i] = mid
+    return mapping
+
+
+# Concatenate tables in order. Ids are re-interned in order of first
+# appearance, so the result is identical to parsing the same packets serially.
+def concat_tables(tables):
+    protocols, protocol_ids = [''], {'': 0}
+    addresses, address_ids = [''], {'': 0}
+    parts = []
+    for table in tables:
+        packets = table.packets.copy()
+        protocol_map = _remap(table.protocols, protocols, protocol_ids)
+        address_map = _remap(table.addresses, addresses, address_ids)
+        for column in ('link', 'network', 'transport', 'application'):
+            packets[column] = protocol_map[packets[column]]
+        for column in ('src', 'dst'):
+            packets[column] = address_map[packets[column]]
+        parts.append(packets)
+    packets = np.concatenate(parts) if parts else np.empty(0, dtype=PACKET_DTYPE)
+    return PacketTable(packets, protocols, addresses)
+
+
+# Total bytes per protocol name for one of the protocol columns
+def protocol_bytes(table, column):
+    ids = table.packets[column]
+    totals = np.bincount(ids, weights=table.lengths, minlength=len(table.protocols))
+    return {table.protocols[pid]: int(totals[pid]) for pid in np.flatnonzero(totals)}
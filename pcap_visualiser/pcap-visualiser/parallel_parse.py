@@ -0,0 +1,92 @@
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pcap_reader import RecordWalker, split_records
+from packet_table import concat_tables, table_from_records
+from sketches import CaptureSketch, sketch_records
+
+# Captures smaller than this are parsed serially; pool overhead dominates
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# Chunks per worker, so uneven chunks still balance across the pool
+CHUNKS_PER_WORKER = 4
+
+# Captures are analysed in this many processes at once (the server's capture
+# pool) in each of the SERVER_PROCESSES_ENV server processes (gunicorn
+# workers, 1 if unset). Each capture process parses with its share of the
+# cores, so a busy machine runs about one parsing process per core.
+CAPTURE_WORKERS = max(2, min(4, os.cpu_count() or 1))
+SERVER_PROCESSES_ENV = 'PCAP_SERVER_PROCESSES'
+
+
+def default_workers():
+    processes = CAPTURE_WORKERS * max(1, int(os.environ.get(SERVER_PROCESSES_ENV, 1)))
+    return max(1, (os.cpu_count() or 1) // processes)
+
+
+def should_parallelise(pcap_file, workers=None):
+    workers = workers or default_workers()
+    return workers > 1 and os.path.getsize(pcap_file) >= PARALLEL_MIN_SIZE
+
+
+# Feed the records of one record-aligned byte range of the capture to
+# consume in a worker process
+def _consume_range(pcap_file, start, end, state, consume):
+    with open(pcap_file, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            walker = RecordWalker.from_state(state)
+            records = ((ts, caplen, wirelen, linktype, mm, offset)
+                       for ts, caplen, wirelen, linktype, offset in walker.walk(mm, start, end))
+            return consume(records)
+        finally:
+            mm.close()
+
+
+def _parse_range(pcap_file, start, end, state):
+    return _consume_range(pcap_file, start, end, state, table_from_records)
+
+
+def _sketch_range(pcap_file, start, end, state):
+    return _consume_range(pcap_file, start, end, state, sketch_records)
+
+
+# Split the capture into record-aligned ranges, run fn on each in a process
+# pool and yield the results in file order. The pool only lives for the
+# call, so no worker processes outlive it.
+def _map_chunks(pcap_file, fn, workers=None):
+    workers = workers or default_workers()
+    with open(pcap_file, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunks = split_records(mm, workers * CHUNKS_PER_WORKER)
+        finally:
+            mm.close()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fn, pcap_file, start, end, state) for start, end, state in chunks]
+        for future in futures:
+            yield future.result()
+
+
+# Parse the capture's ranges across a process pool and merge the partial
+# tables back in file order
+def parse_parallel(pcap_file, workers=None, progress=None):
+    tables = []
+    for table in _map_chunks(pcap_file, _parse_range, workers):
+        tables.append(table)
+        if progress is not None:
+            progress('parsing', sum(len(table) for table in tables))
+    return concat_tables(tables)
+
+
+# Sketch the capture's ranges across a process pool and merge the partial
+# sketches. Only the first gap of each range is lost from the inter-arrival
+# digest.
+def sketch_parallel(pcap_file, workers=None, progress=None):
+    sketch = CaptureSketch()
+    for partial in _map_chunks(pcap_file, _sketch_range, workers):
+        sketch.merge(partial)
+        if progress is not None:
+            progress('parsing', sketch.packets)
+    return sketch
@@ -0,0 +1,493 @@
+import mmap
+import os
+import struct
+
+# Header-level pcap/pcapng reader. Decodes just enough of each record
+# (link, network and transport headers) to label it the way pyshark's
+# highest_layer/transport_layer would, without running tshark.
+
+PCAP_MAGIC_USEC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# pcapng block types
+PCAPNG_IDB = 0x00000001
+PCAPNG_OPB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+
+# Link types we know how to strip
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+RAW_IP_LINKTYPES = {LINKTYPE_RAW, 12, 14}
+
+# Link-layer name of each supported linktype, for the protocol stack
+LINK_NAMES = {
+    LINKTYPE_NULL: 'Loopback',
+    LINKTYPE_ETHERNET: 'Ethernet',
+    LINKTYPE_LINUX_SLL: 'Linux SLL',
+    LINKTYPE_LINUX_SLL2: 'Linux SLL',
+    LINKTYPE_IPV4: 'Raw IP',
+    LINKTYPE_IPV6: 'Raw IP',
+}
+LINK_NAMES.update((linktype, 'Raw IP') for linktype in RAW_IP_LINKTYPES)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_ARP = 0x0806
+ETHERTYPE_IPV6 = 0x86DD
+VLAN_ETHERTYPES = {0x8100, 0x88A8, 0x9100}
+
+IPPROTO_ICMP = 1
+IPPROTO_IGMP = 2
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_ICMPV6 = 58
+IPV6_EXTENSION_HEADERS = {0, 43, 60}
+IPV6_FRAGMENT = 44
+IPV6_AH = 51
+
+# Set on IPv6 addresses returned by decode_packet so they never collide
+# with IPv4 addresses when used as integer keys
+IPV6_TAG = 1 << 128
+
+# Matches the label process_pcap uses when pyshark finds no transport layer
+NO_TRANSPORT = 'Encrypted/unidentified'
+
+# Fields decode_packet returns for matching requests with their responses:
+# (flags, seq, ack, payload). For TCP they are the flags byte, sequence and
+# acknowledgement numbers and payload length; for DNS over UDP the QR bit
+# (DNS_RESPONSE), transaction id, 0 and payload length; for ICMP echo the
+# ICMP type, identifier << 16 | sequence number, 0 and 0. Other packets
+# carry NO_MATCH, whose flags are NO_MATCH_FLAGS: not an ICMP echo type, and
+# skipped by rtt.rtt_samples whatever the transport.
+NO_MATCH_FLAGS = 0xFF
+NO_MATCH = (NO_MATCH_FLAGS, 0, 0, 0)
+DNS_PORT = 53
+DNS_RESPONSE = 0x80
+ICMP_ECHO_TYPES = {0, 8, 128, 129}
+
+# Well-known ports mapped to the layer name Wireshark would report
+TCP_PORT_PROTOCOLS = {
+    21: 'FTP',
+    22: 'SSH',
+    23: 'TELNET',
+    25: 'SMTP',
+    53: 'DNS',
+    80: 'HTTP',
+    110: 'POP',
+    143: 'IMAP',
+    443: 'TLS',
+    1883: 'MQTT',
+    5060: 'SIP',
+    8080: 'HTTP',
+    8443: 'TLS',
+    8883: 'TLS',
+}
+
+UDP_PORT_PROTOCOLS = {
+    53: 'DNS',
+    67: 'DHCP',
+    68: 'DHCP',
+    69: 'TFTP',
+    123: 'NTP',
+    137: 'NBNS',
+    138: 'NBDS',
+    161: 'SNMP',
+    162: 'SNMP',
+    443: 'QUIC',
+    514: 'SYSLOG',
+    1900: 'SSDP',
+    5000: 'UNISTIM',
+    5060: 'SIP',
+    5353: 'MDNS',
+    5355: 'LLMNR',
+    5683: 'COAP',
+}
+
+IP_PROTOCOL_NAMES = {
+    IPPROTO_ICMP: 'ICMP',
+    IPPROTO_IGMP: 'IGMP',
+    IPPROTO_ICMPV6: 'ICMPV6',
+}
+
+PCAP_MAGICS = (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4', b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d')
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+
+# Anything larger is treated as a corrupt record header
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+# Read size used when streaming a capture from a file object
+CHUNK_SIZE = 1024 * 1024
+
+_u16 = struct.Struct('>H')
+_u32 = struct.Struct('>I')
+_ipv4_addrs = struct.Struct('>II')
+_ipv6_addrs = struct.Struct('>QQQQ')
+_ports = struct.Struct('>HH')
+_seq_ack = struct.Struct('>II')
+
+
+class PcapFormatError(ValueError):
+    pass
+
+
+# Label a TCP/UDP payload by port, falling back to the transport itself
+def _application_protocol(ports, sport, dport, payload_len, transport):
+    if payload_len <= 0:
+        return transport
+    proto = ports.get(dport) or ports.get(sport)
+    return proto if proto else 'DATA'
+
+
+# Link-layer name for a linktype, e.g. 'Ethernet' or 'DLT 147'
+def link_name(linktype):
+    return LINK_NAMES.get(linktype) or f"DLT {linktype}"
+
+
+# Decode one captured frame. Returns
+# (network, transport, application, src, dst, sport, dport, match) where
+# src/dst are the integer IPv4/IPv6 addresses (IPv6 tagged with IPV6_TAG, None
+# when there is no IP header), ports are 0 when absent and match holds the
+# request/response matching fields described at NO_MATCH.
+def decode_packet(buf, offset, caplen, linktype):
+    end = offset + caplen
+    ethertype = None
+    pos = offset
+
+    if linktype == LINKTYPE_ETHERNET:
+        if caplen < 14:
+            return 'ETH', NO_TRANSPORT, 'ETH', None, None, 0, 0, NO_MATCH
+        ethertype = _u16.unpack_from(buf, pos + 12)[0]
+        pos += 14
+        while ethertype in VLAN_ETHERTYPES and pos + 4 <= end:
+            ethertype = _u16.unpack_from(buf, pos + 2)[0]
+            pos += 4
+        if ethertype < 0x0600:
+            return 'LLC', NO_TRANSPORT, 'LLC', None, None, 0, 0, NO_MATCH
+    elif linktype in RAW_IP_LINKTYPES or linktype == LINKTYPE_IPV4 or linktype == LINKTYPE_IPV6:
+        if caplen < 1:
+            return 'RAW', NO_TRANSPORT, 'RAW', None, None, 0, 0, NO_MATCH
+        version = buf[pos] >> 4
+        ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6 if version == 6 else None
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if caplen < 16:
+            return 'SLL', NO_TRANSPORT, 'SLL', None, None, 0, 0, NO_MATCH
+        ethertype = _u16.unpack_from(buf, pos + 14)[0]
+        pos += 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if caplen < 20:
+            return 'SLL', NO_TRANSPORT, 'SLL', None, None, 0, 0, NO_MATCH
+        ethertype = _u16.unpack_from(buf, pos)[0]
+        pos += 20
+    elif linktype == LINKTYPE_NULL:
+        if caplen < 4:
+            return 'NULL', NO_TRANSPORT, 'NULL', None, None, 0, 0, NO_MATCH
+        family = buf[pos] | buf[pos + 1] << 8 | buf[pos + 2] << 16 | buf[pos + 3] << 24
+        if family > 0xFFFF:
+            family = _u32.unpack_from(buf, pos)[0]
+        ethertype = ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6 if family in (10, 24, 28, 30) else None
+        pos += 4
+
+    if ethertype == ETHERTYPE_IPV4:
+        if pos + 20 > end:
+            return 'IPv4', NO_TRANSPORT, 'IP', None, None, 0, 0, NO_MATCH
+        ihl = (buf[pos] & 0x0F) * 4
+        total_len = _u16.unpack_from(buf, pos + 2)[0]
+        frag = _u16.unpack_from(buf, pos + 6)[0] & 0x1FFF
+        proto = buf[pos + 9]
+        src, dst = _ipv4_addrs.unpack_from(buf, pos + 12)
+        l4 = pos + ihl
+        l4_end = min(end, pos + total_len) if total_len >= ihl else end
+        network = 'IPv4'
+        if frag:
+            return network, NO_TRANSPORT, 'IP', src, dst, 0, 0, NO_MATCH
+    elif ethertype == ETHERTYPE_IPV6:
+        if pos + 40 > end:
+            return 'IPv6', NO_TRANSPORT, 'IPV6', None, None, 0, 0, NO_MATCH
+        payload_len = _u16.unpack_from(buf, pos + 4)[0]
+        proto = buf[pos + 6]
+        s_hi, s_lo, d_hi, d_lo = _ipv6_addrs.unpack_from(buf, pos + 8)
+        src = IPV6_TAG | s_hi << 64 | s_lo
+        dst = IPV6_TAG | d_hi << 64 | d_lo
+        l4 = pos + 40
+        l4_end = min(end, l4 + payload_len) if payload_len else end
+        network = 'IPv6'
+        while l4 + 8 <= l4_end:
+            if proto in IPV6_EXTENSION_HEADERS:
+                proto, hdr_len = buf[l4], (buf[l4 + 1] + 1) * 8
+            elif proto == IPV6_AH:
+                proto, hdr_len = buf[l4], (buf[l4 + 1] + 2) * 4
+            elif proto == IPV6_FRAGMENT:
+                if _u16.unpack_from(buf, l4 + 2)[0] & 0xFFF8:
+                    return network, NO_TRANSPORT, 'IPV6', src, dst, 0, 0, NO_MATCH
+                proto, hdr_len = buf[l4], 8
+            else:
+                break
+            l4 += hdr_len
+    elif ethertype == ETHERTYPE_ARP:
+        return 'ARP', NO_TRANSPORT, 'ARP', None, None, 0, 0, NO_MATCH
+    else:
+        return 'ETH', NO_TRANSPORT, 'ETH', None, None, 0, 0, NO_MATCH
+
+    if proto == IPPROTO_TCP and l4 + 20 <= l4_end:
+        sport, dport = _ports.unpack_from(buf, l4)
+        payload_len = l4_end - l4 - (buf[l4 + 12] >> 4) * 4
+        app = _application_protocol(TCP_PORT_PROTOCOLS, sport, dport, payload_len, 'TCP')
+        seq, ack = _seq_ack.unpack_from(buf, l4 + 4)
+        match = (buf[l4 + 13], seq, ack, min(max(payload_len, 0), 0xFFFF))
+        return network, 'TCP', app, src, dst, sport, dport, match
+    if proto == IPPROTO_UDP and l4 + 8 <= l4_end:
+        sport, dport = _ports.unpack_from(buf, l4)
+        app = _application_protocol(UDP_PORT_PROTOCOLS, sport, dport, l4_end - l4 - 8, 'UDP')
+        match = NO_MATCH
+        if DNS_PORT in (sport, dport) and l4 + 11 <= end:
+            match = (buf[l4 + 10] & DNS_RESPONSE, _u16.unpack_from(buf, l4 + 8)[0], 0, min(l4_end - l4 - 8, 0xFFFF))
+        return network, 'UDP', app, src, dst, sport, dport, match
+    app = IP_PROTOCOL_NAMES.get(proto, 'IP' if network == 'IPv4' else 'IPV6')
+    match = NO_MATCH
+    if proto in (IPPROTO_ICMP, IPPROTO_ICMPV6) and l4 + 8 <= end and buf[l4] in ICMP_ECHO_TYPES:
+        ident, sequence = _ports.unpack_from(buf, l4 + 4)
+        match = (buf[l4], ident << 16 | sequence, 0, 0)
+    return network, NO_TRANSPORT, app, src, dst, 0, 0, match
+
+
+# Interface description: (linktype, seconds per timestamp tick, offset)
+def _parse_idb(buf, pos, end, endian):
+    linktype = struct.unpack_from(endian + 'H', buf, pos)[0]
+    tsresol = 1e-6
+    tsoffset = 0
+    pos += 8
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', buf, pos)
+        pos += 4
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = buf[pos]
+            tsresol = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        elif code == 14 and length >= 8:
+            tsoffset = struct.unpack_from(endian + 'q', buf, pos)[0]
+        pos += (length + 3) & ~3
+    return linktype, tsresol, tsoffset
+
+
+# Incremental record parser over a byte buffer (bytes, bytearray or mmap).
+# walk() yields (timestamp, caplen, wirelen, linktype, data_offset) for every
+# complete record in buf[pos:end] and leaves `offset` just past the last one,
+# so callers can append more data and resume from there.
+class RecordWalker:
+    def __init__(self):
+        self.format = None
+        self.offset = 0
+        self._endian = '<'
+        self._record = None
+        self._scale = 1e-6
+        self._linktype = None
+        self._interfaces = []
+        self._last_ts = 0.0
+
+    def _parse_pcap_header(self, buf, pos):
+        magic = struct.unpack_from('<I', buf, pos)[0]
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            self._endian = '<'
+        else:
+            self._endian = '>'
+            magic = struct.unpack_from('>I', buf, pos)[0]
+        self._scale = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+        self._linktype = struct.unpack_from(self._endian + 'I', buf, pos + 20)[0] & 0x0FFFFFFF
+        self._record = struct.Struct(self._endian + 'IIII')
+
+    # Plain-data copy of the parser state, so parsing can resume at a record
+    # boundary in another process
+    def get_state(self):
+        return {
+            'format': self.format,
+            'endian': self._endian,
+            'scale': self._scale,
+            'linktype': self._linktype,
+            'interfaces': list(self._interfaces),
+            'last_ts': self._last_ts,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        walker = cls()
+        walker.format = state['format']
+        walker._endian = state['endian']
+        walker._scale = state['scale']
+        walker._linktype = state['linktype']
+        walker._interfaces = list(state['interfaces'])
+        walker._last_ts = state['last_ts']
+        walker._record = struct.Struct(walker._endian + 'IIII')
+        return walker
+
+    # Parse the file header if it has not been seen yet. Returns the offset of
+    # the first record, or None when more data is needed.
+    def read_header(self, buf, pos, end):
+        if self.format is not None:
+            return pos
+        if end - pos < 4:
+            return None
+        magic = bytes(buf[pos:pos + 4])
+        if magic == PCAPNG_MAGIC:
+            self.format = 'pcapng'
+            return pos
+        if magic in PCAP_MAGICS:
+            if end - pos < 24:
+                return None
+            self._parse_pcap_header(buf, pos)
+            self.format = 'pcap'
+            return pos + 24
+        raise PcapFormatError("Unrecognised capture file format")
+
+    def walk(self, buf, pos=0, end=None):
+        if end is None:
+            end = len(buf)
+        self.offset = pos
+        pos = self.read_header(buf, pos, end)
+        if pos is None:
+            return
+        self.offset = pos
+
+        if self.format == 'pcap':
+            yield from self._walk_pcap(buf, pos, end)
+        else:
+            yield from self._walk_pcapng(buf, pos, end)
+
+    def _walk_pcap(self, buf, pos, end):
+        record = self._record
+        scale = self._scale
+        linktype = self._linktype
+        while pos + 16 <= end:
+            ts_sec, ts_frac, caplen, wirelen = record.unpack_from(buf, pos)
+            if caplen > MAX_RECORD_SIZE:
+                raise PcapFormatError("Corrupt pcap record header")
+            next_pos = pos + 16 + caplen
+            if next_pos > end:
+                return
+            self.offset = next_pos
+            yield ts_sec + ts_frac * scale, caplen, wirelen, linktype, pos + 16
+            pos = next_pos
+
+    def _walk_pcapng(self, buf, pos, end):
+        while pos + 12 <= end:
+            if bytes(buf[pos:pos + 4]) == PCAPNG_MAGIC:
+                bom = struct.unpack_from('<I', buf, pos + 8)[0]
+                self._endian = '<' if bom == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                block_type = PCAPNG_SHB
+            else:
+                block_type = struct.unpack_from(self._endian + 'I', buf, pos)[0]
+            endian = self._endian
+            block_len = struct.unpack_from(endian + 'I', buf, pos + 4)[0]
+            if block_len < 12 or block_len > MAX_RECORD_SIZE:
+                raise PcapFormatError("Invalid pcapng block length")
+            next_pos = pos + block_len
+            if next_pos > end:
+                return
+            self.offset = next_pos
+            body = pos + 8
+
+            if block_type == PCAPNG_SHB:
+                self._interfaces = []
+            elif block_type == PCAPNG_IDB:
+                self._interfaces.append(_parse_idb(buf, body, next_pos - 4, endian))
+            elif block_type == PCAPNG_EPB or block_type == PCAPNG_OPB:
+                if block_type == PCAPNG_EPB:
+                    iface, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'IIIII', buf, body)
+                else:
+                    iface, _, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'HHIIII', buf, body)
+                linktype, tsresol, tsoffset = self._interfaces[iface]
+                self._last_ts = ((ts_high << 32) | ts_low) * tsresol + tsoffset
+                yield self._last_ts, min(caplen, block_len - 32), wirelen, linktype, body + 20
+            elif block_type == PCAPNG_SPB and self._interfaces:
+                wirelen = struct.unpack_from(endian + 'I', buf, body)[0]
+                caplen = min(wirelen, block_len - 16)
+                yield self._last_ts, caplen, wirelen, self._interfaces[0][0], body + 4
+            pos = next_pos
+
+
+# Pre-scan record headers and split buf into at most n_chunks record-aligned
+# (start, end, state) ranges of roughly equal size. Each range can be parsed
+# independently with RecordWalker.from_state(state).walk(buf, start, end).
+def split_records(buf, n_chunks):
+    end = len(buf)
+    walker = RecordWalker()
+    start = walker.read_header(buf, 0, end)
+    if start is None:
+        raise PcapFormatError("File is too short to be a capture")
+    step = max(1, (end - start) // max(1, n_chunks))
+    chunks = []
+    chunk_start = start
+    chunk_state = walker.get_state()
+    target = start + step
+
+    if walker.format == 'pcap':
+        record = walker._record
+        pos = start
+        while pos + 16 <= end:
+            if pos >= target:
+                chunks.append((chunk_start, pos, chunk_state))
+                chunk_start = pos
+                target = pos + step
+            pos += 16 + record.unpack_from(buf, pos)[2]
+    else:
+        for _ in walker.walk(buf, start, end):
+            pos = walker.offset
+            if pos >= target and pos < end:
+                chunks.append((chunk_start, pos, chunk_state))
+                chunk_start = pos
+                chunk_state = walker.get_state()
+                target = pos + step
+
+    chunks.append((chunk_start, end, chunk_state))
+    return chunks
+
+
+# Iterate over the records of a pcap or pcapng file object, reading it in
+# chunks. Yields (timestamp, caplen, wirelen, linktype, buf, offset); the
+# packet bytes are buf[offset:offset + caplen] and are only valid until the
+# next record is requested.
+def stream_records(f, chunk_size=CHUNK_SIZE):
+    walker = RecordWalker()
+    buf = bytearray()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        buf += chunk
+        for timestamp, caplen, wirelen, linktype, offset in walker.walk(buf):
+            yield timestamp, caplen, wirelen, linktype, buf, offset
+        del buf[:walker.offset]
+    if walker.format is None:
+        raise PcapFormatError("File is too short to be a capture")
+
+
+# Iterate over the records of a pcap or pcapng file
+def read_records(pcap_file):
+    with open(pcap_file, 'rb') as f:
+        yield from stream_records(f)
+
+
+# Same as read_records, but walks a read-only memory map of the file so no
+# packet bytes are copied and the page cache is shared between analyses
+def map_records(pcap_file):
+    with open(pcap_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise PcapFormatError("File is too short to be a capture")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            walker = RecordWalker()
+            for timestamp, caplen, wirelen, linktype, offset in walker.walk(mm):
+                yield timestamp, caplen, wirelen, linktype, mm, offset
+            if walker.format is None:
+                raise PcapFormatError("File is too short to be a capture")
+        finally:
+            mm.close()
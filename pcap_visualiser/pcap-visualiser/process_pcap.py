@@ -1,252 +1,870 @@
-import pyshark
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-from collections import defaultdict
-import io
-import base64
+import os
 import numpy as np
-
-# Set default font sizes
-plt.rcParams.update({
-    'axes.titlesize': 18,
-    'axes.labelsize': 16,
-    'xtick.labelsize': 16,
-    'ytick.labelsize': 16,
-    'legend.fontsize': 12,
-})
+from pcap_reader import DNS_RESPONSE, ICMP_ECHO_TYPES, NO_MATCH, read_records, map_records
+from packet_table import PROGRESS_PACKETS, PacketTableBuilder, protocol_bytes, table_from_records
+from parallel_parse import parse_parallel, should_parallelise, sketch_parallel
+from result_cache import ResultCache, cache_key
+from downsample import DOWNSAMPLE_MODES, downsample
+from topk import top_n
+from flows import DEFAULT_IDLE_TIMEOUT, FLOW_SORT_KEYS, MAX_IDLE_TIMEOUT, MIN_IDLE_TIMEOUT, build_flows
+from rollup import DEFAULT_ROLLUP_POINTS, Rollup, build_rollups, has_rollups
+from rtt import RTT_DTYPE, RTT_KINDS, rtt_samples, rtt_summary
+from protocol_tree import ProtocolTree, combined_breakdown, stack_rows
+from sampling import CONFIDENCE_LEVEL, SAMPLING_METHODS, protocol_estimates, sample_records
+from sketches import CMS_WIDTH, HLL_PRECISION, TDIGEST_COMPRESSION, sketch_records
+from throughput import MAX_WINDOW, MIN_WINDOW, bin_throughput, moving_average, window_percentiles
+from render import IMAGE_FORMATS, encode_figure, new_figure, render_cache, render_serial
+from sidecar import SIDECAR_SUFFIX, SidecarError, find_sidecar, read_sidecar, sidecar_path, source_info, write_sidecar
+
+# pyshark, pandas, seaborn and matplotlib are imported by the functions that
+# use them rather than here, so importing this module (and starting the
+# server) stays fast. warmup.warm_up() loads them ahead of time.
 
 # CONFIGURATION
 TOP_N = 10
 
-# PCAP files
-def process_pcap(pcap_file):
+# Per-request chart options: time series are reduced to at most max_points
+# points with the given downsample mode before plotting or serialising.
+# Bandwidth is measured over `window` seconds ('auto' picks a window from the
+# capture length) and smoothed with a moving average over `smoothing` windows.
+# Graphs are encoded as image_format at the given DPI and pixel size.
+DEFAULT_OPTIONS = {
+    'max_points': 2000,
+    'downsample': 'lttb',
+    'window': 'auto',
+    'smoothing': 5,
+    'image_format': 'png',
+    'dpi': 100,
+    'width': 1000,
+    'height': 600,
+}
+
+# Upper bound for max_points. "none" keeps every point, so its render time
+# grows with the capture; requests may only ask for it if ALLOW_FULL_SERIES
+# is set.
+MAX_POINTS = 20000
+ALLOW_FULL_SERIES = False
+
+# Bounds for the rendered image size (pixels) and resolution
+MIN_DPI, MAX_DPI = 50, 300
+MIN_IMAGE_SIZE, MAX_IMAGE_SIZE = 200, 4000
+
+# Graphs rendered for every capture, in response order, and the names they
+# go by in per-graph URLs
+GRAPH_KEYS = ('transportGraph', 'appGraph', 'mixedGraph', 'latencyGraph', 'bandwidthGraph')
+GRAPH_KINDS = {
+    'transport': 'transportGraph',
+    'application': 'appGraph',
+    'combined': 'mixedGraph',
+    'latency': 'latencyGraph',
+    'bandwidth': 'bandwidthGraph',
+}
+
+# Per-request flow listing: flows idle for idle_timeout seconds end there,
+# and the first `limit` flows are listed, largest first by `sort`
+DEFAULT_FLOW_QUERY = {
+    'idle_timeout': DEFAULT_IDLE_TIMEOUT,
+    'sort': 'bytes',
+    'limit': 100,
+}
+MAX_FLOW_LIMIT = 10000
+
+# Sampled previews: method is one of sampling.SAMPLING_METHODS, `every` the
+# systematic interval, `size` the reservoir size (per stratum for stratified
+# samples) and `stratum` the stratum length in seconds
+DEFAULT_SAMPLING = {
+    'method': 'systematic',
+    'every': 100,
+    'size': 10000,
+    'stratum': 1.0,
+}
+MAX_SAMPLE_EVERY = 1000000
+MAX_SAMPLE_SIZE = 1000000
+MIN_STRATUM, MAX_STRATUM = 0.001, 86400.0
+
+# Graphs a preview draws. Inter-packet gaps and round trips need consecutive
+# packets, so a sample has no latency graph.
+PREVIEW_GRAPH_KEYS = ('transportGraph', 'appGraph', 'mixedGraph', 'bandwidthGraph')
+
+# "pyshark" runs full Wireshark dissection, "native" only decodes headers and
+# "mmap" does the same over a memory-mapped copy of the file
+ENGINES = ('pyshark', 'native', 'mmap')
+DEFAULT_ENGINE = 'pyshark'
+
+# Merge request overrides into DEFAULT_OPTIONS, raising ValueError for bad values
+def chart_options(overrides=None):
+    options = dict(DEFAULT_OPTIONS)
+    for key, value in (overrides or {}).items():
+        if value is None:
+            continue
+        if key == 'max_points':
+            value = int(value)
+            if not 3 <= value <= MAX_POINTS:
+                raise ValueError(f"max_points must be between 3 and {MAX_POINTS}")
+        elif key == 'downsample':
+            modes = [mode for mode in DOWNSAMPLE_MODES if mode != 'none' or ALLOW_FULL_SERIES]
+            if value not in modes:
+                raise ValueError(f"downsample must be one of {', '.join(modes)}")
+        elif key == 'window':
+            if value != 'auto':
+                value = float(value)
+                if not MIN_WINDOW <= value <= MAX_WINDOW:
+                    raise ValueError(f"window must be 'auto' or between {MIN_WINDOW} and {MAX_WINDOW} seconds")
+        elif key == 'smoothing':
+            value = int(value)
+            if value < 1:
+                raise ValueError("smoothing must be at least 1")
+        elif key == 'image_format':
+            if value not in IMAGE_FORMATS:
+                raise ValueError(f"image_format must be one of {', '.join(IMAGE_FORMATS)}")
+        elif key == 'dpi':
+            value = int(value)
+            if not MIN_DPI <= value <= MAX_DPI:
+                raise ValueError(f"dpi must be between {MIN_DPI} and {MAX_DPI}")
+        elif key in ('width', 'height'):
+            value = int(value)
+            if not MIN_IMAGE_SIZE <= value <= MAX_IMAGE_SIZE:
+                raise ValueError(f"{key} must be between {MIN_IMAGE_SIZE} and {MAX_IMAGE_SIZE} pixels")
+        else:
+            raise ValueError(f"Unknown chart option: {key}")
+        options[key] = value
+    return options
+
+# Merge request overrides into DEFAULT_FLOW_QUERY, raising ValueError for bad values
+def flow_query(overrides=None):
+    query = dict(DEFAULT_FLOW_QUERY)
+    for key, value in (overrides or {}).items():
+        if value is None:
+            continue
+        if key == 'idle_timeout':
+            value = float(value)
+            if not MIN_IDLE_TIMEOUT <= value <= MAX_IDLE_TIMEOUT:
+                raise ValueError(f"idle_timeout must be between {MIN_IDLE_TIMEOUT} and {MAX_IDLE_TIMEOUT} seconds")
+        elif key == 'sort':
+            if value not in FLOW_SORT_KEYS:
+                raise ValueError(f"sort must be one of {', '.join(FLOW_SORT_KEYS)}")
+        elif key == 'limit':
+            value = int(value)
+            if not 1 <= value <= MAX_FLOW_LIMIT:
+                raise ValueError(f"limit must be between 1 and {MAX_FLOW_LIMIT}")
+        else:
+            raise ValueError(f"Unknown flow option: {key}")
+        query[key] = value
+    return query
+
+# Merge request overrides into DEFAULT_SAMPLING, raising ValueError for bad values
+def sampling_options(overrides=None):
+    sampling = dict(DEFAULT_SAMPLING)
+    for key, value in (overrides or {}).items():
+        if value is None:
+            continue
+        if key == 'method':
+            if value not in SAMPLING_METHODS:
+                raise ValueError(f"sampling must be one of {', '.join(SAMPLING_METHODS)}")
+        elif key == 'every':
+            value = int(value)
+            if not 1 <= value <= MAX_SAMPLE_EVERY:
+                raise ValueError(f"sample_every must be between 1 and {MAX_SAMPLE_EVERY}")
+        elif key == 'size':
+            value = int(value)
+            if not 1 <= value <= MAX_SAMPLE_SIZE:
+                raise ValueError(f"sample_size must be between 1 and {MAX_SAMPLE_SIZE}")
+        elif key == 'stratum':
+            value = float(value)
+            if not MIN_STRATUM <= value <= MAX_STRATUM:
+                raise ValueError(f"stratum must be between {MIN_STRATUM} and {MAX_STRATUM} seconds")
+        else:
+            raise ValueError(f"Unknown sampling option: {key}")
+        sampling[key] = value
+    return sampling
+
+# Image encoding options in the form render.py expects
+def image_options(options=None):
+    options = options or DEFAULT_OPTIONS
+    return {
+        'format': options['image_format'],
+        'dpi': options['dpi'],
+        'width': options['width'],
+        'height': options['height'],
+    }
+
+# Cache kind for an output rendered with the given options
+def result_kind(output_format, options):
+    return output_format + ''.join(f"-{key}={options[key]}" for key in sorted(options))
+
+# Assemble the per-capture result shared by every graph generator. Totals
+# and derived arrays (RTT samples and rollups) loaded from a sidecar are used
+# as they are; anything missing is computed from the table.
+def _build_analysis(table, totals=None, arrays=None):
+    if totals is None:
+        totals = {
+            'application': protocol_bytes(table, 'application'),
+            'transport': protocol_bytes(table, 'transport'),
+            'stack': stack_rows(table),
+        }
+    stack = ProtocolTree(totals['stack'])
+    arrays = dict(arrays or {})
+    if 'rtt' not in arrays:
+        arrays['rtt'] = rtt_samples(table)
+    if not has_rollups(arrays):
+        arrays.update(build_rollups(table))
+
+    return {
+        'table': table,
+        'totals': totals,
+        'app_top': top_n(totals['application'], TOP_N),
+        'trans_top': top_n(totals['transport'], TOP_N),
+        'stack': stack,
+        'arrays': arrays,
+        'rtt': arrays['rtt'],
+        'rollup': Rollup(arrays, table),
+        'timestamps': table.timestamps,
+        'packet_sizes': table.lengths,
+    }
+
+# Source/destination address and ports of a pyshark packet, if it has them
+def _pyshark_endpoints(packet):
+    src = dst = None
+    sport = dport = 0
+    if 'IP' in packet:
+        src, dst = packet.ip.src, packet.ip.dst
+    elif 'IPV6' in packet:
+        src, dst = packet.ipv6.src, packet.ipv6.dst
+    if packet.transport_layer:
+        layer = packet[packet.transport_layer]
+        sport = int(getattr(layer, 'srcport', 0) or 0)
+        dport = int(getattr(layer, 'dstport', 0) or 0)
+    return src, dst, sport, dport
+
+# tshark layer names for the bottom two layers of the stack, mapped to the
+# names the native decoder uses
+PYSHARK_LINK_NAMES = {'eth': 'Ethernet', 'sll': 'Linux SLL', 'null': 'Loopback', 'raw': 'Raw IP'}
+PYSHARK_NETWORK_NAMES = {'ip': 'IPv4', 'ipv6': 'IPv6', 'arp': 'ARP'}
+
+# Link and network layer names of a pyshark packet
+def _pyshark_stack(packet):
+    layers = [layer.layer_name for layer in packet.layers[:2]]
+    link = PYSHARK_LINK_NAMES.get(layers[0], layers[0].upper()) if layers else None
+    network = PYSHARK_NETWORK_NAMES.get(layers[1], layers[1].upper()) if len(layers) > 1 else None
+    return link, network
+
+# Request/response matching fields of a pyshark packet, as described at
+# pcap_reader.NO_MATCH
+def _pyshark_match(packet):
+    if 'TCP' in packet:
+        tcp = packet.tcp
+        seq = getattr(tcp, 'seq_raw', None) or tcp.seq
+        ack = getattr(tcp, 'ack_raw', None) or getattr(tcp, 'ack', 0)
+        return int(tcp.flags, 16) & 0xFF, int(seq), int(ack), min(int(tcp.len), 0xFFFF)
+    if 'DNS' in packet and 'UDP' in packet:
+        dns = packet.dns
+        response = DNS_RESPONSE if str(dns.flags_response) in ('1', 'True') else 0
+        return response, int(dns.id, 16), 0, min(int(packet.udp.length) - 8, 0xFFFF)
+    if 'ICMP' in packet:
+        icmp = packet.icmp
+        if int(icmp.type) in ICMP_ECHO_TYPES:
+            return int(icmp.type), int(icmp.ident) << 16 | int(icmp.seq), 0, 0
+    elif 'ICMPV6' in packet:
+        icmpv6 = packet.icmpv6
+        if int(icmpv6.type) in ICMP_ECHO_TYPES:
+            return int(icmpv6.type), int(icmpv6.echo_identifier) << 16 | int(icmpv6.echo_sequence_number), 0, 0
+    return NO_MATCH
+
+# Full dissection through tshark
+def _analyse_pyshark(pcap_file, progress=None):
+    import pyshark
+
     cap = None
     try:
         cap = pyshark.FileCapture(pcap_file, keep_packets=False)
-        app_layer_bytes = defaultdict(int)
-        transport_layer_bytes = defaultdict(int)
+        builder = PacketTableBuilder()
 
         for packet in cap:
             try:
                 app_proto = packet.highest_layer
                 trans_proto = packet.transport_layer if packet.transport_layer else 'Encrypted/unidentified'
                 size = int(packet.length)
-                app_layer_bytes[app_proto] += size
-                transport_layer_bytes[trans_proto] += size
+                timestamp = float(packet.sniff_time.timestamp())
+                src, dst, sport, dport = _pyshark_endpoints(packet)
+                link, network = _pyshark_stack(packet)
             except AttributeError:
                 continue
-
-        df_app = pd.DataFrame({
-            'Application_Protocol': list(app_layer_bytes.keys()),
-            'Total_Bytes': list(app_layer_bytes.values())
-        }).sort_values(by='Total_Bytes', ascending=False)
-
-        df_trans = pd.DataFrame({
-            'Transport_Protocol': list(transport_layer_bytes.keys()),
-            'Total_Bytes': list(transport_layer_bytes.values())
-        }).sort_values(by='Total_Bytes', ascending=False)
-
-        return df_app, df_trans
+            # A missing or malformed matching field only costs the packet its
+            # RTT sample, not its place in the totals
+            try:
+                match = _pyshark_match(packet)
+            except (AttributeError, TypeError, ValueError):
+                match = NO_MATCH
+            builder.add(timestamp, size, trans_proto, app_proto, src, dst, sport, dport, link, network, match)
+            if progress is not None and len(builder) % PROGRESS_PACKETS == 0:
+                progress('parsing', len(builder))
+
+        return _build_analysis(builder.build())
     finally:
         if cap:
             cap.close()
 
-# Top N protocols
+# Header-only decoding straight from the capture records. Large captures
+# are split into record-aligned chunks and parsed on all cores.
+def _analyse_native(pcap_file, use_mmap=False, progress=None):
+    if should_parallelise(pcap_file):
+        return _build_analysis(parse_parallel(pcap_file, progress=progress))
+    records = map_records(pcap_file) if use_mmap else read_records(pcap_file)
+    return _build_analysis(table_from_records(records, progress))
+
+def _analyse(pcap_file, engine, progress=None):
+    if engine == 'native':
+        return _analyse_native(pcap_file, progress=progress)
+    if engine == 'mmap':
+        return _analyse_native(pcap_file, use_mmap=True, progress=progress)
+    return _analyse_pyshark(pcap_file, progress)
+
+def _analysis_from_sidecar(sidecar):
+    return _build_analysis(sidecar['table'], sidecar['totals'], sidecar['arrays'])
+
+def _save_sidecar(path, analysis, engine, digest=None, source=None):
+    write_sidecar(path, analysis['table'], digest, engine, analysis['totals'], source=source,
+                  arrays=analysis['arrays'])
+
+# Single pass over a capture collecting everything the graphs need. A
+# matching summary sidecar next to the capture is loaded instead of re-reading
+# it, and one is written after every fresh analysis. A sidecar holding only a
+# packet table (see register_table) is completed from the table.
+# progress(stage, packets) is called periodically while parsing if given.
+def analyse_pcap(pcap_file, engine=DEFAULT_ENGINE, digest=None, use_sidecar=True, progress=None):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown analysis engine: {engine}")
+    if use_sidecar:
+        sidecar = find_sidecar(pcap_file, engine)
+        if sidecar is not None:
+            analysis = _analysis_from_sidecar(sidecar)
+            if sidecar['totals'] is None:
+                _save_sidecar(sidecar_path(pcap_file, engine), analysis, engine, digest or sidecar['digest'],
+                              source_info(pcap_file))
+            return analysis
+
+    analysis = _analyse(pcap_file, engine, progress)
+    if use_sidecar:
+        try:
+            _save_sidecar(sidecar_path(pcap_file, engine), analysis, engine, digest, source_info(pcap_file))
+        except OSError as e:
+            print(f"Could not write sidecar for {pcap_file}: {e}")
+    return analysis
+
+# Cached analysis for a capture with a known digest, falling back to a full
+# analysis. The cache only refers to the sidecar analyse_pcap() writes next to
+# the capture; a copy is kept in the cache only if that one could not be
+# written.
+def load_analysis(pcap_file, engine=DEFAULT_ENGINE, digest=None, progress=None):
+    if digest is None:
+        return analyse_pcap(pcap_file, engine, progress=progress)
+
+    cache = ResultCache()
+    key = cache_key(digest, engine, 'analysis')
+    path = cache.get(key)
+    if path is not None:
+        try:
+            sidecar = read_sidecar(path)
+            if sidecar['totals'] is not None and sidecar['engine'] == engine and sidecar['digest'] in (None, digest):
+                return _analysis_from_sidecar(sidecar)
+        except (SidecarError, OSError):
+            pass
+
+    analysis = analyse_pcap(pcap_file, engine, digest, progress=progress)
+    path = sidecar_path(pcap_file, engine)
+    if find_sidecar(pcap_file, engine) is None:
+        path = cache.file_path(key, SIDECAR_SUFFIX)
+        _save_sidecar(path, analysis, engine, digest)
+    cache.put(key, os.path.abspath(path))
+    return analysis
+
+# Keep a packet table that was parsed elsewhere (e.g. while the capture was
+# still uploading) in a sidecar next to the capture, without totals. The
+# capture worker then finishes the analysis from it instead of parsing the
+# capture again. Nothing is written for a capture whose analysis is cached.
+def register_table(pcap_file, table, engine, digest):
+    if ResultCache().get(cache_key(digest, engine, 'analysis')) is not None:
+        return
+    if find_sidecar(pcap_file, engine) is None:
+        write_sidecar(sidecar_path(pcap_file, engine), table, digest, engine, None, source=source_info(pcap_file))
+
+# Protocol byte totals as a DataFrame sorted by size, for callers that want
+# pandas; the graphs and API work from the top-N lists instead
+def protocol_frame(protocol_totals, column_name):
+    import pandas as pd
+
+    return pd.DataFrame({
+        column_name: list(protocol_totals.keys()),
+        'Total_Bytes': list(protocol_totals.values())
+    }).sort_values(by='Total_Bytes', ascending=False)
+
+# PCAP files
+def process_pcap(pcap_file, engine=DEFAULT_ENGINE):
+    totals = analyse_pcap(pcap_file, engine)['totals']
+    return protocol_frame(totals['application'], 'Application_Protocol'), protocol_frame(totals['transport'], 'Transport_Protocol')
+
+# Top N protocols of a DataFrame, with the rest grouped as "Other"
 def group_top_n(df, column_name, value_column, n=TOP_N):
-    df_sorted = df.sort_values(by=value_column, ascending=False).reset_index(drop=True)
-    if len(df_sorted) > n:
-        top_df = df_sorted.head(n)
-        other_sum = df_sorted[value_column].iloc[n:].sum()
-        other_row = pd.DataFrame({column_name: ['Other'], value_column: [other_sum]})
-        grouped_df = pd.concat([top_df, other_row], ignore_index=True)
-    else:
-        grouped_df = df_sorted
-    grouped_df['Percentage'] = (grouped_df[value_column] / grouped_df[value_column].sum()) * 100
-    return grouped_df
+    import pandas as pd
+
+    grouped = top_n(dict(zip(df[column_name], df[value_column])), n)
+    return pd.DataFrame({
+        column_name: grouped.labels,
+        value_column: grouped.values,
+        'Percentage': grouped.percentages,
+    })
 
 # Function to generate Application Protocol graph
-def generate_application_graph(df_app):
-    df_app_group = group_top_n(df_app, 'Application_Protocol', 'Total_Bytes')
+def generate_application_graph(app_top, image=None):
+    import seaborn as sns
+    from matplotlib.patches import Rectangle
 
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig = new_figure(image)
+    ax = fig.subplots()
 
-    palette = sns.color_palette("viridis", len(df_app_group))
-    sns.barplot(x="Application_Protocol", y="Percentage", data=df_app_group, palette=palette, ax=ax, hue="Application_Protocol", legend=False)
+    palette = sns.color_palette("viridis", len(app_top.labels))
+    sns.barplot(x=app_top.labels, y=app_top.percentages, palette=palette, ax=ax, hue=app_top.labels, legend=False)
     ax.set_title("Application Protocols", pad=30) 
     ax.set_xlabel("")
+    ax.set_ylabel("Percentage")
     ax.set_xticklabels([])
 
     # Create legend handles
-    handles = [plt.Rectangle((0, 0), 1, 1, color=c) for c in palette]
+    handles = [Rectangle((0, 0), 1, 1, color=c) for c in palette]
 
     # Place legend under the title and on top of the graph box
-    ax.legend(handles, df_app_group['Application_Protocol'], title="Protocols",
+    ax.legend(handles, app_top.labels, title="Protocols",
               loc='upper center', bbox_to_anchor=(0.5, 1.1), ncol=3, frameon=True)
 
-    img_data = io.BytesIO()
-    fig.savefig(img_data, format='png')
-    img_data.seek(0)
-    img_base64 = base64.b64encode(img_data.read()).decode('utf-8')
-    plt.close(fig)
-
-    return img_base64
+    return encode_figure(fig, image)
 
 
 # Function to generate Transport Protocol graph
-def generate_transport_graph(df_trans):
-    df_trans_group = group_top_n(df_trans, 'Transport_Protocol', 'Total_Bytes')
+def generate_transport_graph(trans_top, image=None):
+    import seaborn as sns
+    from matplotlib.patches import Rectangle
 
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig = new_figure(image)
+    ax = fig.subplots()
 
-    palette = sns.color_palette("viridis", len(df_trans_group))
-    sns.barplot(x="Transport_Protocol", y="Percentage", data=df_trans_group, palette=palette, ax=ax, hue="Transport_Protocol", legend=False)
+    palette = sns.color_palette("viridis", len(trans_top.labels))
+    sns.barplot(x=trans_top.labels, y=trans_top.percentages, palette=palette, ax=ax, hue=trans_top.labels, legend=False)
     ax.set_title("Transport Protocols", pad = 30)
     ax.set_xlabel("")
+    ax.set_ylabel("Percentage")
     ax.set_xticklabels([])
 
     # Create legend handles
-    handles = [plt.Rectangle((0, 0), 1, 1, color=c) for c in palette]
+    handles = [Rectangle((0, 0), 1, 1, color=c) for c in palette]
 
     # Place legend under the title and on top of the graph box
-    ax.legend(handles, df_trans_group['Transport_Protocol'], title="Protocols",
+    ax.legend(handles, trans_top.labels, title="Protocols",
               loc='upper center', bbox_to_anchor=(0.5, 1.1), ncol=3, frameon=True)
 
-    img_data = io.BytesIO()
-    fig.savefig(img_data, format='png')
-    img_data.seek(0)
-    img_base64 = base64.b64encode(img_data.read()).decode('utf-8')
-    plt.close(fig)
-
-    return img_base64
+    return encode_figure(fig, image)
 
-# Function to generate Combined Application and Transport Protocol graph
-def generate_combined_graph(df_app, df_trans):
-    df_app_group = group_top_n(df_app, 'Application_Protocol', 'Total_Bytes')
-    df_trans_group = group_top_n(df_trans, 'Transport_Protocol', 'Total_Bytes')
+# Function to generate Combined Application and Transport Protocol graph:
+# one bar per transport, stacked by the applications it carried, from a
+# protocol_tree.combined_breakdown
+def generate_combined_graph(breakdown, image=None):
+    import seaborn as sns
+    from matplotlib.patches import Rectangle
 
-    df_app_group['Protocol'] = df_app_group['Application_Protocol']
+    transports, applications, shares = breakdown
+    fig = new_figure(image)
+    ax = fig.subplots()
 
-    fig, ax = plt.subplots(figsize=(10, 6))
-
-    palette = sns.color_palette("viridis", len(df_app_group))
-    sns.barplot(x="Protocol", y="Percentage", data=df_app_group, palette=palette, ax=ax, hue="Protocol", legend=False)
+    palette = sns.color_palette("viridis", len(applications))
+    bottoms = np.zeros(len(transports))
+    for color, row in zip(palette, shares):
+        ax.bar(transports, row, bottom=bottoms, color=color)
+        bottoms += row
     ax.set_title("Combined Application & Transport Protocols", pad=30)
     ax.set_xlabel("")
-    ax.set_xticklabels([])
+    ax.set_ylabel("Percentage")
 
     # Create legend handles
-    handles = [plt.Rectangle((0, 0), 1, 1, color=c) for c in palette]
+    handles = [Rectangle((0, 0), 1, 1, color=c) for c in palette]
 
     # Place legend under the title and on top of the graph box
-    ax.legend(handles, df_app_group['Protocol'], title="Protocols",
+    ax.legend(handles, applications, title="Protocols",
               loc='upper center', bbox_to_anchor=(0.5, 1.1), ncol=3, frameon=True)
 
-    img_data = io.BytesIO()
-    fig.savefig(img_data, format='png')
-    img_data.seek(0)
-    img_base64 = base64.b64encode(img_data.read()).decode('utf-8')
-    plt.close(fig)
-
-    return img_base64
-
-def calculate_latency_and_bandwidth(pcap_file):
-    cap = pyshark.FileCapture(pcap_file, keep_packets=False)
-
-    timestamps = []
-    packet_sizes = []
-
-    for packet in cap:
-        try:
-            timestamps.append(float(packet.sniff_time.timestamp()))
-            packet_sizes.append(int(packet.length))
-        except AttributeError:
-            continue
-
-    cap.close()
-
-    if len(timestamps) < 2:
-        return None, None
-
-    # Calculate latency (differences in timestamps)
-    latencies = np.diff(timestamps) * 1000  # convert to ms
-    avg_latency = np.mean(latencies)
-
-    # Calculate bandwidth (bytes per second)
-    duration = timestamps[-1] - timestamps[0]
-    bandwidth = sum(packet_sizes) / duration if duration > 0 else 0
-
-    return avg_latency, bandwidth
-
-def calculate_latency_and_bandwidth(pcap_file):
-    cap = pyshark.FileCapture(pcap_file, keep_packets=False)
-
-    timestamps = []
-    packet_sizes = []
-
-    for packet in cap:
-        try:
-            timestamps.append(float(packet.sniff_time.timestamp()))
-            packet_sizes.append(int(packet.length))
-        except AttributeError:
-            continue
-
-    cap.close()
-
-    if len(timestamps) < 2:
-        return None, None, None, None
-
-    return timestamps, packet_sizes
-
-def generate_latency_graph(timestamps):
-    if len(timestamps) < 2:
-        return None
-
-    latencies = np.diff(timestamps) * 1000  # convert to milliseconds
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(timestamps[1:], latencies, marker="o", linestyle="-", color="blue", label="Latency (ms)")
+    return encode_figure(fig, image)
+
+# Gap between consecutive packets in milliseconds, against packet time
+def latency_series(timestamps):
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    return timestamps[1:], np.diff(timestamps) * 1000  # convert to milliseconds
+
+# Downsampled latency series ready to plot or serialise
+def latency_points(timestamps, options=None):
+    options = options or DEFAULT_OPTIONS
+    return downsample(*latency_series(timestamps), options['max_points'], options['downsample'])
+
+# Round-trip time samples in milliseconds against request time, downsampled
+# separately for each kind of sample, as {kind: (times, rtts)}
+def rtt_points(samples, options=None):
+    options = options or DEFAULT_OPTIONS
+    series = {}
+    for kind_id, kind in enumerate(RTT_KINDS):
+        rows = samples[samples['kind'] == kind_id]
+        if len(rows):
+            series[kind] = downsample(rows['timestamp'], rows['rtt'] * 1000, options['max_points'], options['downsample'])
+    return series
+
+# Downsampled windowed bandwidth and its moving average, plus the window size
+# and per-window rate percentiles
+def bandwidth_points(timestamps, packet_sizes, options=None):
+    options = options or DEFAULT_OPTIONS
+    throughput = bin_throughput(timestamps, packet_sizes, options['window'])
+    rates = throughput['bytes_per_second']
+    times, bandwidths = downsample(throughput['times'], rates, options['max_points'], options['downsample'])
+    avg_times, averages = downsample(throughput['times'], moving_average(rates, options['smoothing']),
+                                     options['max_points'], options['downsample'])
+    return {
+        'window': throughput['window'],
+        'smoothing': options['smoothing'],
+        'times': times,
+        'bandwidths': bandwidths,
+        'avg_times': avg_times,
+        'averages': averages,
+        'percentiles': window_percentiles(rates),
+    }
+
+# Fallback latency graph for captures without any request/response pairs:
+# the gap between consecutive packets
+def plot_latency_graph(times, latencies, image=None):
+    fig = new_figure(image)
+    ax = fig.subplots()
+    ax.plot(times, latencies, marker="o", linestyle="-", color="blue", label="Inter-packet gap (ms)")
     
-    ax.set_title("Latency Over Time")
+    ax.set_title("Inter-packet Gap Over Time")
     ax.set_xlabel("Timestamp")
-    ax.set_ylabel("Latency (ms)")
+    ax.set_ylabel("Gap (ms)")
     ax.legend()
     ax.grid(True)
 
-    img_data = io.BytesIO()
-    fig.savefig(img_data, format="png")
-    img_data.seek(0)
-    img_base64 = base64.b64encode(img_data.read()).decode("utf-8")
-    plt.close(fig)
+    return encode_figure(fig, image)
 
-    return img_base64
+# Latency graph: one series of round-trip times per kind of sample
+def plot_rtt_graph(series, image=None):
+    fig = new_figure(image)
+    ax = fig.subplots()
+    for kind, (times, rtts) in series.items():
+        ax.plot(times, rtts, marker="o", markersize=3, linestyle="", label=kind)
 
+    ax.set_title("Round-trip Time Over Time")
+    ax.set_xlabel("Timestamp")
+    ax.set_ylabel("RTT (ms)")
+    ax.legend()
+    ax.grid(True)
 
-def generate_bandwidth_graph(timestamps, packet_sizes):
-    if len(timestamps) < 2:
-        return None
-
-    bandwidths = []
-    for i in range(1, len(timestamps)):
-        time_diff = timestamps[i] - timestamps[i - 1]
-        if time_diff > 0:
-            bandwidths.append(packet_sizes[i] / time_diff)  # Bytes per second
-        else:
-            bandwidths.append(0)
+    return encode_figure(fig, image)
 
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(timestamps[1:], bandwidths, marker="o", linestyle="-", color="green", label="Bandwidth (Bytes/sec)")
+def plot_bandwidth_graph(bandwidth, image=None):
+    fig = new_figure(image)
+    ax = fig.subplots()
+    ax.plot(bandwidth['times'], bandwidth['bandwidths'], marker="o", linestyle="-", color="green", label="Bandwidth (Bytes/sec)")
+    if bandwidth['smoothing'] > 1:
+        ax.plot(bandwidth['avg_times'], bandwidth['averages'], linestyle="-", color="black",
+                label=f"Moving average ({bandwidth['smoothing']} windows)")
 
-    ax.set_title("Bandwidth Over Time")
+    ax.set_title(f"Bandwidth Over Time ({bandwidth['window']:g} s windows)")
     ax.set_xlabel("Timestamp")
     ax.set_ylabel("Bandwidth (Bytes/sec)")
     ax.legend()
     ax.grid(True)
 
-    img_data = io.BytesIO()
-    fig.savefig(img_data, format="png")
-    img_data.seek(0)
-    img_base64 = base64.b64encode(img_data.read()).decode("utf-8")
-    plt.close(fig)
-
-    return img_base64
+    return encode_figure(fig, image)
+
+# Top-N protocol table as plain lists for JSON output
+def _protocol_data(top):
+    return {
+        'protocols': list(top.labels),
+        'bytes': [int(value) for value in top.values],
+        'percentages': [round(float(value), 3) for value in top.percentages],
+    }
+
+# Time series relative to the capture start, rounded to keep payloads small
+def _series_data(times, values, start, value_digits=3):
+    return {
+        't': np.round(np.asarray(times) - start, 6).tolist(),
+        'y': np.round(np.nan_to_num(values), value_digits).tolist(),
+    }
+
+# Everything the front end needs to draw the five charts itself, without
+# rendering any images on the server
+def build_chart_data(analysis, options=None):
+    options = options or DEFAULT_OPTIONS
+    timestamps = analysis['timestamps']
+    start = float(timestamps[0]) if len(timestamps) else 0.0
+    data = {
+        'packets': int(len(timestamps)),
+        'totalBytes': int(np.sum(analysis['packet_sizes'], dtype=np.int64)),
+        'start': start,
+        'application': _protocol_data(analysis['app_top']),
+        'transport': _protocol_data(analysis['trans_top']),
+        'stack': analysis['stack'].to_dict(),
+        'sankey': analysis['stack'].sankey(),
+        'rtt': rtt_summary(analysis['rtt'], analysis['table']),
+        'latency': None,
+        'bandwidth': None,
+    }
+    rtt = analysis['rtt']
+    if len(rtt):
+        times, rtts = downsample(rtt['timestamp'], rtt['rtt'] * 1000, options['max_points'], options['downsample'])
+        data['latency'] = _series_data(times, rtts, start)
+        data['latency']['source'] = 'rtt'
+    elif len(timestamps) >= 2:
+        data['latency'] = _series_data(*latency_points(timestamps, options), start)
+        data['latency']['source'] = 'gap'
+    if len(timestamps) >= 2:
+        bandwidth = bandwidth_points(timestamps, analysis['packet_sizes'], options)
+        data['bandwidth'] = _series_data(bandwidth['times'], bandwidth['bandwidths'], start, 1)
+        data['bandwidth']['window'] = bandwidth['window']
+        data['bandwidth']['average'] = _series_data(bandwidth['avg_times'], bandwidth['averages'], start, 1)
+        data['bandwidth']['percentiles'] = bandwidth['percentiles']
+    return data
+
+# Render task for one graph of an analysed capture, as (function, args), or
+# None if the capture has too few packets for it. The arguments are already
+# reduced to what is drawn, so they are cheap to send to a render worker.
+def graph_task(analysis, key, options=None):
+    options = options or DEFAULT_OPTIONS
+    image = image_options(options)
+    timestamps = analysis['timestamps']
+    if key == 'transportGraph':
+        return generate_transport_graph, (analysis['trans_top'], image)
+    if key == 'appGraph':
+        return generate_application_graph, (analysis['app_top'], image)
+    if key == 'mixedGraph':
+        return generate_combined_graph, (combined_breakdown(analysis['stack'], TOP_N), image)
+    if key == 'latencyGraph' and len(analysis['rtt']):
+        return plot_rtt_graph, (rtt_points(analysis['rtt'], options), image)
+    if len(timestamps) < 2:
+        return None
+    if key == 'latencyGraph':
+        return plot_latency_graph, (*latency_points(timestamps, options), image)
+    if key == 'bandwidthGraph':
+        return plot_bandwidth_graph, (bandwidth_points(timestamps, analysis['packet_sizes'], options), image)
+    raise ValueError(f"Unknown graph: {key}")
+
+# Render tasks for every graph of an analysed capture, as {key: (function,
+# args)}. Graphs a capture has too few packets for have no task.
+def graph_tasks(analysis, options=None):
+    tasks = {key: graph_task(analysis, key, options) for key in GRAPH_KEYS}
+    return {key: task for key, task in tasks.items() if task is not None}
+
+# Analyse one capture and return the render task for a single graph. Runs
+# in a capture worker process; the analysis is usually already cached.
+def prepare_capture_graph(pcap_file, engine=DEFAULT_ENGINE, digest=None, key='transportGraph', options=None):
+    options = chart_options(options)
+    return graph_task(load_analysis(pcap_file, engine, digest), key, options)
+
+# Drill-down into one capture's protocol stack: the node at `path` (protocol
+# names from the link layer down) with `depth` layers below it, or None if no
+# packet took that path. Runs in a capture worker process.
+def capture_stack(pcap_file, engine=DEFAULT_ENGINE, digest=None, path=(), depth=None):
+    stack = load_analysis(pcap_file, engine, digest)['stack']
+    node = stack.node(path)
+    return stack.to_dict(node, depth) if node is not None else None
+
+# Flows of one capture: how many there are and the first `limit` of them, or
+# only those between the endpoints (src, sport, dst, dport, transport) if
+# given. Runs in a capture worker process.
+def capture_flows(pcap_file, engine=DEFAULT_ENGINE, digest=None, query=None, endpoints=None):
+    query = flow_query(query)
+    flows = build_flows(load_analysis(pcap_file, engine, digest)['table'], query['idle_timeout'])
+    rows = flows.find(*endpoints) if endpoints is not None else None
+    return {
+        'idleTimeout': query['idle_timeout'],
+        'flows': len(flows),
+        'items': flows.records(query['sort'], query['limit'], rows),
+    }
+
+# Round-trip time distributions of one capture, per kind of sample and for
+# the flow_limit flows with the most samples. Runs in a capture worker process.
+def capture_rtt(pcap_file, engine=DEFAULT_ENGINE, digest=None, flow_limit=DEFAULT_FLOW_QUERY['limit']):
+    analysis = load_analysis(pcap_file, engine, digest)
+    return rtt_summary(analysis['rtt'], analysis['table'], flow_limit)
+
+# Bytes, packets and top protocols per time bucket between start and end
+# (seconds from the first packet), from the finest rollup tier that fits the
+# range in max_points buckets. Runs in a capture worker process.
+def capture_series(pcap_file, engine=DEFAULT_ENGINE, digest=None, start=None, end=None,
+                   max_points=DEFAULT_ROLLUP_POINTS, top=TOP_N):
+    return load_analysis(pcap_file, engine, digest)['rollup'].query(start, end, max_points, top)
+
+# Analyse one capture and return the render tasks for its graphs. Runs in a
+# capture worker process; the graphs themselves are drawn in the render pool.
+# progress(stage, packets) is told about each stage if given.
+def prepare_capture_graphs(pcap_file, engine=DEFAULT_ENGINE, digest=None, progress=None, options=None):
+    options = chart_options(options)
+    if progress is not None:
+        progress('parsing', 0)
+    analysis = load_analysis(pcap_file, engine, digest, progress)
+    if progress is not None:
+        progress('rendering', len(analysis['table']))
+    return graph_tasks(analysis, options)
+
+# Remember which rendered graphs belong to a capture. Only the render keys
+# are stored under the capture's digest; the images live in the render cache.
+def cache_capture_graphs(graphs, engine, digest, options=None):
+    if digest:
+        keys = {key: graph_key for key, (graph_key, _) in graphs.items()}
+        ResultCache().put(cache_key(digest, engine, result_kind('graphs', chart_options(options))), keys)
+
+# Previously rendered graphs of a capture as {key: (render key, image)}, or
+# None unless every one of them is still in the render cache
+def cached_capture_graphs(digest, engine, options=None):
+    keys = ResultCache().get(cache_key(digest, engine, result_kind('graphs', chart_options(options))))
+    if keys is None:
+        return None
+    graphs = {}
+    for key, graph_key in keys.items():
+        graph = render_cache.get(graph_key) if graph_key else None
+        if graph_key and graph is None:
+            return None
+        graphs[key] = (graph_key, graph)
+    return graphs
+
+# Analyse one capture and return its chart series instead of images
+def generate_capture_data(pcap_file, engine=DEFAULT_ENGINE, digest=None, progress=None, options=None):
+    options = chart_options(options)
+    if progress is not None:
+        progress('parsing', 0)
+    analysis = load_analysis(pcap_file, engine, digest, progress)
+    data = build_chart_data(analysis, options)
+    if digest:
+        ResultCache().put(cache_key(digest, engine, result_kind('data', options)), data)
+    if progress is not None:
+        progress('done')
+    return data
+
+# Percentiles reported from the sketch digests
+SKETCH_PERCENTILES = (50, 90, 99)
+
+# Stream a capture's records through fixed-size sketches instead of building
+# a packet table. Headers are always decoded natively, whatever the engine.
+def sketch_pcap(pcap_file, use_mmap=False, progress=None):
+    if should_parallelise(pcap_file):
+        return sketch_parallel(pcap_file, progress=progress)
+    records = map_records(pcap_file) if use_mmap else read_records(pcap_file)
+    return sketch_records(records, progress)
+
+# Minimum, mean, maximum and percentiles of a t-digest, scaled by `scale`
+def _digest_data(digest, scale=1, digits=3):
+    data = {'count': int(digest.count)}
+    if digest.count == 0:
+        return data
+    data['min'] = round(digest.min * scale, digits)
+    data['mean'] = round(digest.mean() * scale, digits)
+    data['max'] = round(digest.max * scale, digits)
+    for p in SKETCH_PERCENTILES:
+        data[f"p{p}"] = round(digest.quantile(p / 100) * scale, digits)
+    return data
+
+# JSON summary of a capture sketch. Packet and byte counts are exact;
+# everything else is an estimate within the bounds given in errorBounds.
+def sketch_data(sketch, n=TOP_N):
+    return {
+        'approximate': True,
+        'packets': sketch.packets,
+        'totalBytes': sketch.bytes,
+        'start': sketch.first or 0.0,
+        'duration': round(sketch.last - sketch.first, 6) if sketch.packets else 0.0,
+        'distinctHosts': sketch.hosts.estimate(),
+        'distinctFlows': sketch.flows.estimate(),
+        'application': _protocol_data(sketch.top(sketch.applications, n)),
+        'transport': _protocol_data(sketch.top(sketch.transports, n)),
+        'talkers': _protocol_data(sketch.top(sketch.talkers, n)),
+        'packetSize': _digest_data(sketch.sizes),
+        'interArrival': _digest_data(sketch.gaps, scale=1000, digits=6),
+        'errorBounds': {
+            'distinctRelativeError': round(1.04 / 2 ** (HLL_PRECISION / 2), 4),
+            'bytesOverestimate': int(np.ceil(np.e / CMS_WIDTH * sketch.bytes)),
+            'digestCompression': TDIGEST_COMPRESSION,
+        },
+    }
+
+# Sketch one capture in fixed memory and return the CaptureSketch, which
+# server.format_results summarises (and merges across captures)
+def generate_capture_sketch(pcap_file, engine=DEFAULT_ENGINE, digest=None, progress=None, options=None):
+    options = chart_options(options)
+    if progress is not None:
+        progress('parsing', 0)
+    sketch = sketch_pcap(pcap_file, engine == 'mmap', progress)
+    if digest:
+        ResultCache().put(cache_key(digest, engine, result_kind('sketch', options)), sketch)
+    if progress is not None:
+        progress('done')
+    return sketch
+
+# Sample a capture's records and decode only the sample. Headers are always
+# decoded natively, whatever the engine.
+def sample_pcap(pcap_file, sampling=None, use_mmap=False, progress=None):
+    sampling = sampling_options(sampling)
+    records = map_records(pcap_file) if use_mmap else read_records(pcap_file)
+    return sample_records(records, sampling['method'], sampling['every'], sampling['size'],
+                          sampling['stratum'], progress)
+
+# Estimated protocol table with the confidence interval of every percentage
+# and the byte range it implies
+def _estimate_data(estimate, total_bytes):
+    top, low, high = estimate
+    data = _protocol_data(top)
+    data['percentageRange'] = [[round(l, 3), round(h, 3)] for l, h in zip(low, high)]
+    data['bytesRange'] = [[int(l / 100 * total_bytes), int(round(h / 100 * total_bytes))] for l, h in zip(low, high)]
+    return data
+
+# The parts of an analysis graph_task needs, estimated from a sample: totals
+# and bandwidth are weighted by how many packets each sampled one stands for
+def _sample_analysis(sample, app_estimate, trans_estimate):
+    table = sample.table
+    weights = sample.weights
+    return {
+        'table': table,
+        'app_top': app_estimate[0],
+        'trans_top': trans_estimate[0],
+        'stack': ProtocolTree(stack_rows(table, weights)),
+        'rtt': np.empty(0, dtype=RTT_DTYPE),
+        'timestamps': table.timestamps,
+        'packet_sizes': table.lengths * weights,
+    }
+
+# Sample one capture and render preview graphs from the estimates, returning
+# {'graphs': {key: (render key, image)}, 'estimates': {...}}. Packet and byte
+# totals are exact; protocol shares come with CONFIDENCE_LEVEL intervals.
+def generate_capture_preview(pcap_file, engine=DEFAULT_ENGINE, digest=None, progress=None, options=None,
+                             sampling=None):
+    options = chart_options(options)
+    sampling = sampling_options(sampling)
+    if progress is not None:
+        progress('parsing', 0)
+    sample = sample_pcap(pcap_file, sampling, engine == 'mmap', progress)
+    app_estimate = protocol_estimates(sample, 'application', TOP_N)
+    trans_estimate = protocol_estimates(sample, 'transport', TOP_N)
+    if progress is not None:
+        progress('rendering', sample.packets)
+
+    analysis = _sample_analysis(sample, app_estimate, trans_estimate)
+    tasks = {key: graph_task(analysis, key, options) for key in PREVIEW_GRAPH_KEYS}
+    graphs = render_serial({key: task for key, task in tasks.items() if task is not None})
+    preview = {
+        'graphs': graphs,
+        'estimates': {
+            'method': sample.method,
+            'sampledPackets': len(sample.table),
+            'packets': sample.packets,
+            'totalBytes': sample.bytes,
+            'confidence': CONFIDENCE_LEVEL,
+            'application': _estimate_data(app_estimate, sample.bytes),
+            'transport': _estimate_data(trans_estimate, sample.bytes),
+        },
+    }
+    if digest:
+        ResultCache().put(cache_key(digest, engine, result_kind('preview', dict(options, **sampling))), preview)
+    if progress is not None:
+        progress('done')
+    return preview
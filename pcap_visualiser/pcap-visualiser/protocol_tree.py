@@ -0,0 +1,157 @@
+import numpy as np
+from topk import OTHER_LABEL, top_n
+
+# Protocol stack aggregation: every packet is counted once under its
+# link -> network -> transport -> application path, with byte and packet
+# totals at every node. The per-layer tables, the combined graph, the Sankey
+# and drill-down queries are all answered from the tree, so none of them
+# needs another pass over the capture.
+STACK_LAYERS = ('link', 'network', 'transport', 'application')
+
+# Name used for a layer a packet has no protocol for (protocol id 0)
+UNKNOWN_PROTOCOL = 'Unknown'
+
+
+# One [link, network, transport, application, bytes, packets] row per
+# distinct protocol stack in a packet table. The four protocol ids are packed
+# into one integer per packet and grouped with np.unique and bincount. With
+# per-packet weights (e.g. from a sample) the totals are weighted sums,
+# rounded to whole bytes and packets.
+def stack_rows(table, weights=None):
+    packets = table.packets
+    if len(packets) == 0:
+        return []
+    keys = np.zeros(len(packets), dtype=np.uint64)
+    for layer in STACK_LAYERS:
+        keys = (keys << np.uint64(16)) | packets[layer].astype(np.uint64)
+    stacks, inverse = np.unique(keys, return_inverse=True)
+    if weights is None:
+        stack_bytes = np.bincount(inverse, weights=packets['length'], minlength=len(stacks))
+        stack_packets = np.bincount(inverse, minlength=len(stacks))
+    else:
+        stack_bytes = np.rint(np.bincount(inverse, weights=packets['length'] * weights, minlength=len(stacks)))
+        stack_packets = np.rint(np.bincount(inverse, weights=weights, minlength=len(stacks)))
+
+    names = [name or UNKNOWN_PROTOCOL for name in table.protocols]
+    rows = []
+    for key, nbytes, npackets in zip(stacks.tolist(), stack_bytes.tolist(), stack_packets.tolist()):
+        path = [names[(key >> shift) & 0xFFFF] for shift in (48, 32, 16, 0)]
+        rows.append(path + [int(nbytes), int(npackets)])
+    return rows
+
+
+def _node(name, layer):
+    return {'name': name, 'layer': layer, 'bytes': 0, 'packets': 0, 'children': {}}
+
+
+class ProtocolTree:
+    def __init__(self, rows):
+        self.rows = rows
+        self.root = _node('All', None)
+        for *path, nbytes, npackets in rows:
+            node = self.root
+            node['bytes'] += nbytes
+            node['packets'] += npackets
+            for layer, name in zip(STACK_LAYERS, path):
+                child = node['children'].get(name)
+                if child is None:
+                    child = node['children'][name] = _node(name, layer)
+                child['bytes'] += nbytes
+                child['packets'] += npackets
+                node = child
+
+    @classmethod
+    def from_table(cls, table):
+        return cls(stack_rows(table))
+
+    # Node at the end of a path of protocol names from the link layer down,
+    # e.g. ('Ethernet', 'IPv4', 'TCP'), or None if no packet took that path
+    def node(self, path=()):
+        node = self.root
+        for name in path:
+            node = node['children'].get(name)
+            if node is None:
+                return None
+        return node
+
+    # {protocol: total} for one layer, summed over every path through it
+    def layer_totals(self, layer, metric='bytes'):
+        index = STACK_LAYERS.index(layer)
+        value = 4 if metric == 'bytes' else 5
+        totals = {}
+        for row in self.rows:
+            totals[row[index]] = totals.get(row[index], 0) + row[value]
+        return totals
+
+    # {outer protocol: {inner protocol: total}} between two layers, e.g. the
+    # applications carried by each transport
+    def breakdown(self, outer, inner, metric='bytes'):
+        outer_index = STACK_LAYERS.index(outer)
+        inner_index = STACK_LAYERS.index(inner)
+        value = 4 if metric == 'bytes' else 5
+        totals = {}
+        for row in self.rows:
+            inner_totals = totals.setdefault(row[outer_index], {})
+            inner_totals[row[inner_index]] = inner_totals.get(row[inner_index], 0) + row[value]
+        return totals
+
+    # Sankey diagram of the stack: one node per (layer, protocol) and one link
+    # per pair of adjacent layers a packet passed between. Links refer to
+    # nodes by index, as plotly's go.Sankey expects.
+    def sankey(self, metric='bytes'):
+        value = 4 if metric == 'bytes' else 5
+        nodes = []
+        node_ids = {}
+        links = {}
+        for row in self.rows:
+            ids = []
+            for layer, name in zip(STACK_LAYERS, row):
+                node_id = node_ids.get((layer, name))
+                if node_id is None:
+                    node_id = node_ids[(layer, name)] = len(nodes)
+                    nodes.append({'layer': layer, 'name': name})
+                ids.append(node_id)
+            for link in zip(ids, ids[1:]):
+                links[link] = links.get(link, 0) + row[value]
+        return {
+            'nodes': nodes,
+            'links': [{'source': source, 'target': target, 'value': total}
+                      for (source, target), total in links.items()],
+        }
+
+    # JSON form of a node and its children, largest first, down to `depth`
+    # further layers (all of them if None). Percentages are of the whole
+    # capture.
+    def to_dict(self, node=None, depth=None):
+        node = node or self.root
+        total = self.root['bytes']
+        data = {
+            'name': node['name'],
+            'layer': node['layer'],
+            'bytes': node['bytes'],
+            'packets': node['packets'],
+            'percentage': round(node['bytes'] / total * 100, 3) if total else 0.0,
+        }
+        if node['children'] and (depth is None or depth > 0):
+            children = sorted(node['children'].values(), key=lambda child: child['bytes'], reverse=True)
+            data['children'] = [self.to_dict(child, None if depth is None else depth - 1) for child in children]
+        return data
+
+
+# What the combined graph draws: the top n transports along the x axis, each
+# split into the top n applications, as percentages of all bytes. Returned as
+# plain tuples (transports, applications, shares) where shares[i][j] is
+# application i's share carried over transport j.
+def combined_breakdown(tree, n):
+    transports = top_n(tree.layer_totals('transport'), n).labels
+    applications = top_n(tree.layer_totals('application'), n).labels
+    by_transport = tree.breakdown('transport', 'application')
+    total = tree.root['bytes'] or 1
+
+    shares = [[0.0] * len(transports) for _ in applications]
+    for transport, app_totals in by_transport.items():
+        j = transports.index(transport) if transport in transports else transports.index(OTHER_LABEL)
+        for application, nbytes in app_totals.items():
+            i = applications.index(application) if application in applications else applications.index(OTHER_LABEL)
+            shares[i][j] += nbytes / total * 100
+    return tuple(transports), tuple(applications), tuple(tuple(row) for row in shares)
@@ -0,0 +1,231 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import numpy as np
+from result_cache import CACHE_FOLDER, ResultCache
+
+# Graphs are drawn on standalone Figures with their own Agg canvas instead of
+# through pyplot, so no global figure state is shared and any number of
+# graphs can be rendered at once. matplotlib is only imported, and the style
+# applied, when the first figure is created.
+
+# Default font sizes for every graph
+STYLE = {
+    'axes.titlesize': 18,
+    'axes.labelsize': 16,
+    'xtick.labelsize': 16,
+    'ytick.labelsize': 16,
+    'legend.fontsize': 12,
+}
+
+# Image encoding of a rendered graph: file format, resolution and size in
+# pixels. The default matches matplotlib's 10x6 inch figure at 100 DPI.
+IMAGE_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+}
+DEFAULT_IMAGE = {'format': 'png', 'dpi': 100, 'width': 1000, 'height': 600}
+
+# Graphs are rendered in their own pool of worker processes, separate from
+# the capture workers, so one request's graphs are drawn side by side
+RENDER_WORKERS = max(2, min(10, os.cpu_count() or 1))
+render_pool = None
+
+# Rendered graphs are cached by a digest of the graph function, its inputs
+# (including the image options) and the style, so identical charts (e.g. the
+# same baseline capture) are never drawn twice. The most recent entries are
+# kept in memory and every entry is also written to the on-disk result cache.
+RENDER_CACHE_ENTRIES = 256
+RENDER_CACHE_DISK = True
+
+_styled = False
+
+
+def _matplotlib():
+    global _styled
+    import matplotlib
+    if not _styled:
+        matplotlib.rcParams.update(STYLE)
+        _styled = True
+    return matplotlib
+
+
+def new_figure(image=None):
+    _matplotlib()
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    image = image or DEFAULT_IMAGE
+    fig = Figure(figsize=(image['width'] / image['dpi'], image['height'] / image['dpi']), dpi=image['dpi'])
+    FigureCanvasAgg(fig)
+    return fig
+
+
+# Encode a figure as raw image bytes. PNGs are written with Pillow's
+# optimiser and WebPs losslessly, which suits flat chart colours.
+def encode_figure(fig, image=None):
+    image = image or DEFAULT_IMAGE
+    img_data = io.BytesIO()
+    if image['format'] == 'png':
+        fig.savefig(img_data, format='png', dpi=image['dpi'], pil_kwargs={'optimize': True})
+    elif image['format'] == 'webp':
+        fig.savefig(img_data, format='webp', dpi=image['dpi'], pil_kwargs={'lossless': True})
+    else:
+        fig.savefig(img_data, format=image['format'], dpi=image['dpi'])
+    return img_data.getvalue()
+
+
+# MIME type of encoded image bytes
+def image_mimetype(data):
+    if data.startswith(b'\x89PNG'):
+        return IMAGE_FORMATS['png']
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return IMAGE_FORMATS['webp']
+    return IMAGE_FORMATS['svg']
+
+
+# Pool initializer: load seaborn and the style and build the font cache once
+# per worker, so the first real graph does not pay for it
+def warm_renderer():
+    import seaborn  # noqa: F401
+    _matplotlib()
+    fig = new_figure({'format': 'png', 'dpi': 100, 'width': 100, 'height': 100})
+    ax = fig.subplots()
+    ax.set_title("warm-up")
+    ax.legend(["warm-up"])
+    encode_figure(fig)
+
+
+def _ready():
+    return os.getpid()
+
+
+def get_render_pool():
+    global render_pool
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=warm_renderer)
+    return render_pool
+
+
+# Start every render worker now rather than on the first request
+def warm_render_pool():
+    pool = get_render_pool()
+    for future in [pool.submit(_ready) for _ in range(RENDER_WORKERS)]:
+        future.result()
+
+
+# Feed a value's content into a hash. Arrays are hashed by their data, not
+# their identity.
+def _hash_value(h, value):
+    if isinstance(value, np.ndarray):
+        h.update(f"{value.dtype.str}{value.shape}".encode('utf-8'))
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        h.update(b'{')
+        for key in sorted(value):
+            h.update(repr(key).encode('utf-8'))
+            _hash_value(h, value[key])
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for item in value:
+            _hash_value(h, item)
+        h.update(b']')
+    else:
+        h.update(repr(value).encode('utf-8'))
+
+
+def render_key(function, args):
+    h = hashlib.sha256()
+    h.update(f"{function.__module__}.{function.__qualname__}".encode('utf-8'))
+    _hash_value(h, (STYLE, _matplotlib().__version__))
+    _hash_value(h, args)
+    return h.hexdigest()
+
+
+# Bounded in-memory LRU of rendered graphs, optionally backed by the on-disk
+# result cache
+class RenderCache:
+    def __init__(self, max_entries=RENDER_CACHE_ENTRIES, folder=CACHE_FOLDER if RENDER_CACHE_DISK else None):
+        self.max_entries = max_entries
+        self.folder = folder
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+
+    def _disk_cache(self):
+        if self._disk is None and self.folder is not None:
+            self._disk = ResultCache(self.folder)
+        return self._disk
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        disk = self._disk_cache()
+        if disk is None:
+            return None
+        value = disk.get(f"render-{key}")
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        disk = self._disk_cache()
+        if disk is not None:
+            disk.put(f"render-{key}", value)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+render_cache = RenderCache()
+
+
+# Submit {key: (function, args)} render tasks to the render pool, returning
+# {key: (render key, future)}. Graphs already in the render cache come back
+# as completed futures without touching matplotlib.
+def submit_renders(tasks, cache=render_cache):
+    pool = get_render_pool()
+    futures = {}
+    for key, (function, args) in tasks.items():
+        graph_key = render_key(function, args)
+        cached = cache.get(graph_key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+        else:
+            future = pool.submit(function, *args)
+            future.add_done_callback(lambda done, graph_key=graph_key: _store(cache, graph_key, done))
+        futures[key] = (graph_key, future)
+    return futures
+
+
+def _store(cache, graph_key, future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        cache.put(graph_key, future.result())
+
+
+# Run render tasks in the current process, one after another, returning
+# {key: (render key, graph)}
+def render_serial(tasks, cache=render_cache):
+    graphs = {}
+    for key, (function, args) in tasks.items():
+        graph_key = render_key(function, args)
+        graph = cache.get(graph_key)
+        if graph is None:
+            graph = function(*args)
+            if graph is not None:
+                cache.put(graph_key, graph)
+        graphs[key] = (graph_key, graph)
+    return graphs
@@ -0,0 +1,87 @@
+import os
+import pickle
+import tempfile
+
+# Bump when the layout of cached values changes
+CACHE_VERSION = 5
+
+CACHE_FOLDER = 'cache'
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+# Cache key for one kind of result ('analysis', 'graphs', ...) derived from
+# a capture's SHA-256 digest and the engine that analysed it
+def cache_key(digest, engine, kind):
+    return f"{digest}-{engine}-{kind}"
+
+
+# Content-addressed on-disk cache. Entries are plain files named after the
+# key, so every worker process sharing the folder sees the same cache.
+# Reads refresh the entry's mtime and the oldest entries are evicted once the
+# folder grows past max_bytes.
+class ResultCache:
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        return self.file_path(key, '.pkl')
+
+    # Location of a raw file entry, for values stored in their own format
+    def file_path(self, key, suffix):
+        return os.path.join(self.folder, f"v{CACHE_VERSION}-{key}{suffix}")
+
+    def get_file(self, key, suffix):
+        path = self.file_path(key, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+            return value
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    # Drop least recently used entries until the folder fits in max_bytes
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,234 @@
+import numpy as np
+from topk import OTHER_LABEL
+
+# Multi-resolution rollups for zoomable charts. Bytes and packets, overall
+# and per application protocol, are counted in buckets of every resolution
+# in ROLLUP_RESOLUTIONS. Tiers are sparse (empty buckets are not stored).
+# Tiers from ROLLUP_STORED_FROM up are kept in the capture's summary
+# sidecar: the finest of them is built from the packets and each coarser one
+# from the one below it, so a range query is a pair of binary searches in one
+# tier. The finer tiers would hold close to a row per packet, so they are
+# not stored; a query that needs one counts the packets in its range
+# instead, which are few for a range short enough to need it.
+#
+# Bucket boundaries of every tier line up: buckets are counted from the
+# whole minute before the first packet.
+#
+# Only the capture's ROLLUP_PROTOCOLS largest application protocols are
+# counted on their own; the rest share protocol id 0 ("Other"), so a tier has
+# at most ROLLUP_PROTOCOLS + 1 protocol rows per bucket. No tier has more
+# rows than the capture has packets.
+
+ROLLUP_RESOLUTIONS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0)
+ROLLUP_STORED_FROM = 2
+
+# Range queries return at most this many buckets unless the range is too
+# long even for the coarsest tier
+DEFAULT_ROLLUP_POINTS = 1000
+MAX_ROLLUP_POINTS = 100000
+
+ROLLUP_PROTOCOLS = 10
+
+# Tiers are stored column by column, so binary searches over the bin column
+# run on contiguous (memory-mapped) arrays. Per-protocol tiers are sorted by
+# bin, then protocol id.
+TIER_COLUMNS = {'bin': '<i8', 'bytes': '<u8', 'packets': '<u4'}
+PROTOCOL_TIER_COLUMNS = {'bin': '<i8', 'protocol': '<u2', 'bytes': '<u8', 'packets': '<u4'}
+
+_PROTOCOL_SPACE = 1 << 16
+
+
+def _tier_name(tier, column):
+    return f"rollup-{tier}-{column}"
+
+
+def _protocol_tier_name(tier, column):
+    return f"rollup-{tier}-protocol-{column}"
+
+
+# Sum bytes and packets per distinct key
+def _group(keys, nbytes, npackets):
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return (keys,
+            np.bincount(inverse, weights=nbytes, minlength=len(keys)),
+            np.bincount(inverse, weights=npackets, minlength=len(keys)))
+
+
+def _tier(bins, nbytes, npackets):
+    bins, nbytes, npackets = _group(bins, nbytes, npackets)
+    return {
+        'bin': bins.astype(TIER_COLUMNS['bin']),
+        'bytes': nbytes.astype(TIER_COLUMNS['bytes']),
+        'packets': npackets.astype(TIER_COLUMNS['packets']),
+    }
+
+
+def _protocol_tier(keys, nbytes, npackets):
+    keys, nbytes, npackets = _group(keys, nbytes, npackets)
+    return {
+        'bin': (keys // _PROTOCOL_SPACE).astype(PROTOCOL_TIER_COLUMNS['bin']),
+        'protocol': (keys % _PROTOCOL_SPACE).astype(PROTOCOL_TIER_COLUMNS['protocol']),
+        'bytes': nbytes.astype(PROTOCOL_TIER_COLUMNS['bytes']),
+        'packets': npackets.astype(PROTOCOL_TIER_COLUMNS['packets']),
+    }
+
+
+# Tier rows, overall and per protocol, of packets at `resolution`.
+# protocol_ids maps every application protocol id to itself if it is
+# counted on its own and to 0 otherwise.
+def _count(packets, origin, resolution, protocol_ids):
+    bins = np.floor((packets['timestamp'] - origin) / resolution).astype(np.int64)
+    lengths = packets['length'].astype(np.float64)
+    ones = np.ones(len(bins))
+    keys = bins * _PROTOCOL_SPACE + protocol_ids[packets['application']]
+    return _tier(bins, lengths, ones), _protocol_tier(keys, lengths, ones)
+
+
+def _store(arrays, tier, totals, protocols):
+    for column, values in totals.items():
+        arrays[_tier_name(tier, column)] = values
+    for column, values in protocols.items():
+        arrays[_protocol_tier_name(tier, column)] = values
+
+
+# Every stored tier of a packet table as named arrays for the sidecar, plus
+# 'rollup-origin' holding the time buckets are counted from and the first and
+# last packet times, and 'rollup-protocols' holding the ids of the protocols
+# counted on their own
+def build_rollups(table):
+    timestamps = np.asarray(table.timestamps, dtype=np.float64)
+    if len(timestamps) == 0:
+        arrays = {'rollup-origin': np.zeros(3), 'rollup-protocols': np.empty(0, dtype='<u2')}
+        for tier in range(ROLLUP_STORED_FROM, len(ROLLUP_RESOLUTIONS)):
+            _store(arrays, tier,
+                   {column: np.empty(0, dtype=dtype) for column, dtype in TIER_COLUMNS.items()},
+                   {column: np.empty(0, dtype=dtype) for column, dtype in PROTOCOL_TIER_COLUMNS.items()})
+        return arrays
+
+    first, last = float(timestamps.min()), float(timestamps.max())
+    origin = np.floor(first / ROLLUP_RESOLUTIONS[-1]) * ROLLUP_RESOLUTIONS[-1]
+    protocol_bytes = np.bincount(table.packets['application'], weights=table.lengths.astype(np.float64),
+                                 minlength=len(table.protocols))
+    kept = np.argsort(-protocol_bytes, kind='stable')[:ROLLUP_PROTOCOLS]
+    arrays = {'rollup-origin': np.array([origin, first, last]), 'rollup-protocols': kept.astype('<u2')}
+
+    protocol_ids = np.zeros(len(table.protocols), dtype=np.int64)
+    protocol_ids[kept] = kept
+    totals, protocols = _count(table.packets, origin, ROLLUP_RESOLUTIONS[ROLLUP_STORED_FROM], protocol_ids)
+    _store(arrays, ROLLUP_STORED_FROM, totals, protocols)
+
+    for tier in range(ROLLUP_STORED_FROM + 1, len(ROLLUP_RESOLUTIONS)):
+        factor = int(round(ROLLUP_RESOLUTIONS[tier] / ROLLUP_RESOLUTIONS[tier - 1]))
+        totals = _tier(totals['bin'] // factor, totals['bytes'], totals['packets'])
+        protocols = _protocol_tier((protocols['bin'] // factor) * _PROTOCOL_SPACE + protocols['protocol'],
+                                   protocols['bytes'], protocols['packets'])
+        _store(arrays, tier, totals, protocols)
+    return arrays
+
+
+def has_rollups(arrays):
+    return 'rollup-origin' in arrays and 'rollup-protocols' in arrays and all(
+        all(_tier_name(tier, column) in arrays for column in TIER_COLUMNS)
+        and all(_protocol_tier_name(tier, column) in arrays for column in PROTOCOL_TIER_COLUMNS)
+        for tier in range(ROLLUP_STORED_FROM, len(ROLLUP_RESOLUTIONS)))
+
+
+class Rollup:
+    def __init__(self, arrays, table):
+        self.origin, self.first, self.last = (float(value) for value in arrays['rollup-origin'])
+        stored = range(ROLLUP_STORED_FROM, len(ROLLUP_RESOLUTIONS))
+        self.tiers = {tier: {column: arrays[_tier_name(tier, column)] for column in TIER_COLUMNS}
+                      for tier in stored}
+        self.protocol_tiers = {tier: {column: arrays[_protocol_tier_name(tier, column)] for column in PROTOCOL_TIER_COLUMNS}
+                               for tier in stored}
+        self.table = table
+        self.protocols = table.protocols
+        kept = arrays['rollup-protocols'].astype(np.int64)
+        self.protocol_ids = np.zeros(len(self.protocols), dtype=np.int64)
+        self.protocol_ids[kept] = kept
+        self._sorted = None
+
+    # Overall and per-protocol rows of a tier, counted from the packets
+    # between first_bin and last_bin if the tier is not stored
+    def _rows(self, tier, first_bin, last_bin):
+        if tier in self.tiers:
+            return self.tiers[tier], self.protocol_tiers[tier]
+        resolution = ROLLUP_RESOLUTIONS[tier]
+        low = self.origin + first_bin * resolution
+        high = self.origin + (last_bin + 1) * resolution
+        timestamps = self.table.timestamps
+        if self._sorted is None:
+            self._sorted = bool(np.all(np.diff(timestamps) >= 0))
+        if self._sorted:
+            rows = slice(np.searchsorted(timestamps, low, side='left'), np.searchsorted(timestamps, high, side='left'))
+        else:
+            rows = (timestamps >= low) & (timestamps < high)
+        return _count(self.table.packets[rows], self.origin, resolution, self.protocol_ids)
+
+    # Finest tier that covers `span` seconds in no more than max_points
+    # buckets, or the coarsest tier if none does
+    def tier_for(self, span, max_points=DEFAULT_ROLLUP_POINTS):
+        for tier, resolution in enumerate(ROLLUP_RESOLUTIONS):
+            if span / resolution < max_points:
+                return tier
+        return len(ROLLUP_RESOLUTIONS) - 1
+
+    # Bytes and packets per bucket between start and end (seconds from the
+    # first packet, clamped to the capture; the whole capture by default) from
+    # the tier chosen by tier_for, plus per-bucket bytes of the top n
+    # protocols in that range with the rest as "Other". Buckets are dense:
+    # empty ones are zero. Raises ValueError if even the coarsest tier needs
+    # more than MAX_ROLLUP_POINTS buckets for the range.
+    def query(self, start=None, end=None, max_points=DEFAULT_ROLLUP_POINTS, top=10):
+        duration = self.last - self.first
+        start = 0.0 if start is None else float(start)
+        end = duration if end is None else float(end)
+        if not (np.isfinite(start) and np.isfinite(end)):
+            raise ValueError("start and end must be finite")
+        if end < start:
+            raise ValueError("end must not be before start")
+        start = min(max(start, 0.0), duration)
+        end = min(max(end, 0.0), duration)
+        tier = self.tier_for(end - start, max_points)
+        resolution = ROLLUP_RESOLUTIONS[tier]
+        first_bin = int(np.floor((self.first + start - self.origin) / resolution))
+        last_bin = int(np.floor((self.first + end - self.origin) / resolution))
+        count = last_bin - first_bin + 1
+        if count > MAX_ROLLUP_POINTS:
+            raise ValueError(f"Range needs {count} buckets at {resolution} s, more than {MAX_ROLLUP_POINTS}")
+
+        totals, per_protocol = self._rows(tier, first_bin, last_bin)
+        lo = np.searchsorted(totals['bin'], first_bin, side='left')
+        hi = np.searchsorted(totals['bin'], last_bin, side='right')
+        offsets = totals['bin'][lo:hi] - first_bin
+        nbytes = np.zeros(count, dtype=np.int64)
+        npackets = np.zeros(count, dtype=np.int64)
+        nbytes[offsets] = totals['bytes'][lo:hi]
+        npackets[offsets] = totals['packets'][lo:hi]
+
+        lo = np.searchsorted(per_protocol['bin'], first_bin, side='left')
+        hi = np.searchsorted(per_protocol['bin'], last_bin, side='right')
+        offsets = per_protocol['bin'][lo:hi] - first_bin
+        ids = per_protocol['protocol'][lo:hi]
+        protocol_bytes = per_protocol['bytes'][lo:hi].astype(np.int64)
+        range_totals = np.bincount(ids, weights=protocol_bytes, minlength=len(self.protocols))
+        ranked = [int(pid) for pid in np.argsort(-range_totals, kind='stable') if pid and range_totals[pid] > 0][:top]
+        protocols = {}
+        for pid in ranked:
+            rows = ids == pid
+            series = protocols[self.protocols[pid]] = np.zeros(count, dtype=np.int64)
+            series[offsets[rows]] = protocol_bytes[rows]
+        rows = ~np.isin(ids, ranked)
+        if rows.any():
+            series = protocols[OTHER_LABEL] = np.zeros(count, dtype=np.int64)
+            np.add.at(series, offsets[rows], protocol_bytes[rows])
+
+        return {
+            'resolution': resolution,
+            'captureStart': self.first,
+            'start': round(self.origin + first_bin * resolution - self.first, 6),
+            'buckets': count,
+            'bytes': nbytes.tolist(),
+            'packets': npackets.tolist(),
+            'protocols': {name: series.tolist() for name, series in protocols.items()},
+        }
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+import numpy as np
+from flows import flow_key
+from pcap_reader import DNS_RESPONSE, NO_MATCH_FLAGS
+
+# Round-trip times measured at the capture point, by matching each request
+# with its response:
+#
+# "tcp-handshake" SYN -> SYN-ACK
+# "tcp-data"      data segment (or SYN-ACK) -> the ACK acknowledging exactly
+#                 its last byte
+# "dns"           DNS query -> response with the same transaction id
+# "icmp"          ICMP/ICMPv6 echo request -> reply with the same identifier
+#                 and sequence number
+#
+# Requests wait in bounded pending tables: entries older than timeout are
+# expired and a full table drops its oldest entry, so memory stays constant
+# however long the capture is. A request seen twice (a retransmission) gives
+# no sample, since the response cannot be attributed to either copy (Karn's
+# algorithm).
+
+RTT_KINDS = ('tcp-handshake', 'tcp-data', 'dns', 'icmp')
+PENDING_TIMEOUT = 10.0
+MAX_PENDING = 65536
+
+RTT_PERCENTILES = (50, 90, 99)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+ICMP_ECHO_REQUESTS = {8, 128}
+ICMP_ECHO_REPLIES = {0, 129}
+SEQ_MASK = 0xFFFFFFFF
+
+# One row per sample, oriented from the requester. rtt is in seconds and
+# timestamp is when the request was sent.
+RTT_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('rtt', '<f8'),
+    ('kind', 'u1'),
+    ('src', '<u4'),
+    ('dst', '<u4'),
+    ('sport', '<u2'),
+    ('dport', '<u2'),
+    ('transport', '<u2'),
+])
+
+
+# Requests awaiting a response, oldest first
+class PendingTable:
+    def __init__(self, timeout=PENDING_TIMEOUT, max_entries=MAX_PENDING):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def expire(self, now):
+        entries = self._entries
+        while entries:
+            sent, _ = next(iter(entries.values()))
+            if sent >= now - self.timeout:
+                break
+            entries.popitem(last=False)
+
+    def add(self, key, timestamp):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] = True
+            return
+        self.expire(timestamp)
+        self._entries[key] = [timestamp, False]
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Send time of the request answered at `timestamp`, or None if there is
+    # none or it was retransmitted
+    def match(self, key, timestamp):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[1] or timestamp - entry[0] > self.timeout:
+            return None
+        return entry[0]
+
+
+# Match requests and responses over a packet table in capture order,
+# returning an RTT_DTYPE array sorted by request time
+def rtt_samples(table, timeout=PENDING_TIMEOUT, max_pending=MAX_PENDING):
+    packets = table.packets
+    tcp = table.protocol_id('TCP')
+    udp = table.protocol_id('UDP')
+    dns = table.protocol_id('DNS')
+    icmp = [pid for pid in (table.protocol_id('ICMP'), table.protocol_id('ICMPV6')) if pid >= 0]
+    if tcp < 0 and dns < 0 and not icmp:
+        return np.empty(0, dtype=RTT_DTYPE)
+    rows = packets[((packets['transport'] == tcp)
+                    | ((packets['transport'] == udp) & (packets['application'] == dns))
+                    | np.isin(packets['application'], icmp))
+                   & (packets['flags'] != NO_MATCH_FLAGS)]
+
+    handshakes, segments, queries, echoes = (PendingTable(timeout, max_pending) for _ in RTT_KINDS)
+    samples = []
+    columns = ('timestamp', 'transport', 'application', 'src', 'dst', 'sport', 'dport', 'flags', 'seq', 'ack', 'payload')
+    for ts, transport, application, src, dst, sport, dport, flags, seq, ack, payload in zip(*(rows[c].tolist() for c in columns)):
+        if transport == tcp:
+            if flags & TCP_SYN:
+                if flags & TCP_ACK:
+                    sent = handshakes.match((dst, dport, src, sport, ack), ts)
+                    if sent is not None:
+                        samples.append((sent, ts - sent, 0, dst, src, dport, sport, transport))
+                    segments.add((src, sport, dst, dport, (seq + 1) & SEQ_MASK), ts)
+                else:
+                    handshakes.add((src, sport, dst, dport, (seq + 1) & SEQ_MASK), ts)
+                continue
+            if flags & TCP_ACK:
+                sent = segments.match((dst, dport, src, sport, ack), ts)
+                if sent is not None:
+                    samples.append((sent, ts - sent, 1, dst, src, dport, sport, transport))
+            if payload or flags & TCP_FIN:
+                segments.add((src, sport, dst, dport, (seq + payload + (flags & TCP_FIN)) & SEQ_MASK), ts)
+        elif transport == udp:
+            if flags & DNS_RESPONSE:
+                sent = queries.match((dst, dport, src, sport, seq), ts)
+                if sent is not None:
+                    samples.append((sent, ts - sent, 2, dst, src, dport, sport, transport))
+            else:
+                queries.add((src, sport, dst, dport, seq), ts)
+        elif flags in ICMP_ECHO_REQUESTS:
+            echoes.add((src, dst, seq), ts)
+        elif flags in ICMP_ECHO_REPLIES:
+            sent = echoes.match((dst, src, seq), ts)
+            if sent is not None:
+                samples.append((sent, ts - sent, 3, dst, src, 0, 0, transport))
+
+    samples = np.array(samples, dtype=RTT_DTYPE)
+    return samples[np.argsort(samples['timestamp'], kind='stable')]
+
+
+# Count, mean, extremes and percentiles of RTTs in milliseconds
+def rtt_distribution(rtts, percentiles=RTT_PERCENTILES):
+    rtts = np.asarray(rtts, dtype=np.float64) * 1000
+    distribution = {'samples': int(len(rtts))}
+    if len(rtts) == 0:
+        return distribution
+    distribution['min'] = round(float(rtts.min()), 3)
+    distribution['mean'] = round(float(rtts.mean()), 3)
+    distribution['max'] = round(float(rtts.max()), 3)
+    for p, value in zip(percentiles, np.percentile(rtts, percentiles)):
+        distribution[f"p{p}"] = round(float(value), 3)
+    return distribution
+
+
+# RTT distributions of a capture per kind of sample and for the flow_limit
+# flows with the most samples
+def rtt_summary(samples, table, flow_limit=20):
+    protocols = {}
+    for kind_id, kind in enumerate(RTT_KINDS):
+        rtts = samples['rtt'][samples['kind'] == kind_id]
+        if len(rtts):
+            protocols[kind] = rtt_distribution(rtts)
+
+    flows = {}
+    for row, key in enumerate(map(flow_key, samples['src'].tolist(), samples['sport'].tolist(),
+                                  samples['dst'].tolist(), samples['dport'].tolist(),
+                                  samples['transport'].tolist())):
+        flows.setdefault(key, []).append(row)
+    busiest = sorted(flows.values(), key=len, reverse=True)[:flow_limit]
+    flow_data = []
+    for rows in busiest:
+        sample = samples[rows[0]]
+        flow = {
+            'src': table.addresses[sample['src']],
+            'sport': int(sample['sport']),
+            'dst': table.addresses[sample['dst']],
+            'dport': int(sample['dport']),
+            'transport': 'ICMP' if sample['kind'] == RTT_KINDS.index('icmp') else table.protocols[sample['transport']],
+        }
+        flow.update(rtt_distribution(samples['rtt'][rows]))
+        flow_data.append(flow)
+
+    return {'samples': int(len(samples)), 'protocols': protocols, 'flows': flow_data}
@@ -0,0 +1,166 @@
+import math
+import random
+import numpy as np
+from packet_table import PROGRESS_PACKETS, table_from_records
+from topk import OTHER_LABEL, TopN, top_n
+
+# Sampled previews of a capture. Every record header is still read (pcap
+# has no index to skip by), but only the sampled packets are decoded:
+#
+# "systematic" every Nth record, from a random start
+# "reservoir"  a uniform random sample of `size` records from the whole
+#              capture
+# "stratified" a uniform random sample of `size` records from every
+#              `stratum` seconds of capture, so quiet periods are not drowned
+#              out by bursts
+#
+# The records seen and their bytes are counted exactly. Each sampled packet
+# stands for population / sampled packets of its stratum (the whole capture
+# for systematic and reservoir samples). Protocol shares are ratio
+# estimates; their confidence intervals come from the stratified
+# (linearised) variance of the ratio. A systematic sample is treated as a
+# simple random one, which holds unless traffic repeats with a period of N
+# packets.
+
+SAMPLING_METHODS = ('systematic', 'reservoir', 'stratified')
+
+# Seeded so the same capture and options always give the same preview
+SAMPLING_SEED = 0
+
+# z for two-sided 95% confidence intervals
+CONFIDENCE_LEVEL = 0.95
+CONFIDENCE_Z = 1.959964
+
+
+# Copy a record's packet bytes out of the reader's buffer, which is reused
+# (streamed) or closed (memory-mapped) once the next record is read
+def _detach(record):
+    timestamp, caplen, wirelen, linktype, buf, offset = record
+    return timestamp, caplen, wirelen, linktype, bytes(buf[offset:offset + caplen]), 0
+
+
+class Sample:
+    def __init__(self, method, table, strata, population, sampled, packets, nbytes):
+        self.method = method
+        self.table = table
+        # Stratum of every sampled packet, and the packets each stratum had
+        # and had sampled
+        self.strata = strata
+        self.population = population
+        self.sampled = sampled
+        # Exact totals over every record
+        self.packets = packets
+        self.bytes = nbytes
+
+    # Packets each sampled packet stands for
+    @property
+    def weights(self):
+        return (self.population / self.sampled)[self.strata]
+
+
+# Index of the next record Algorithm L puts into a full reservoir of `size`
+# after `seen` records, and the updated threshold w
+def _next_skip(seen, size, w, rng):
+    w *= math.exp(math.log(1.0 - rng.random()) / size)
+    return seen + int(math.log(1.0 - rng.random()) / math.log(1.0 - w)) + 1, w
+
+
+# Draw the sampled records of each stratum as {stratum: [records seen,
+# [(index, record)], next replaced index, w]}, returning it with the exact
+# packet and byte counts. Reservoirs use Algorithm L, which draws random
+# numbers only for the records it keeps rather than for every record.
+def _draw(records, method, every, size, stratum, rng, progress):
+    strata = {}
+    packets = nbytes = 0
+    start = rng.randrange(every)
+    origin = None
+    for record in records:
+        h = 0
+        if method == 'stratified':
+            if origin is None:
+                origin = record[0]
+            h = int((record[0] - origin) // stratum)
+        entry = strata.get(h)
+        if entry is None:
+            entry = strata[h] = [0, [], None, 1.0]
+        seen, kept = entry[0], entry[1]
+        if method == 'systematic':
+            if packets % every == start:
+                kept.append((packets, _detach(record)))
+        elif seen < size:
+            kept.append((packets, _detach(record)))
+            if seen + 1 == size:
+                entry[2], entry[3] = _next_skip(seen, size, entry[3], rng)
+        elif seen == entry[2]:
+            kept[rng.randrange(size)] = (packets, _detach(record))
+            entry[2], entry[3] = _next_skip(seen, size, entry[3], rng)
+        entry[0] = seen + 1
+        packets += 1
+        nbytes += record[2]
+        if progress is not None and packets % PROGRESS_PACKETS == 0:
+            progress('parsing', packets)
+    return strata, packets, nbytes
+
+
+# Sample (timestamp, caplen, wirelen, linktype, buf, offset) records from
+# pcap_reader and decode the sample into a packet table, in capture order
+def sample_records(records, method='systematic', every=100, size=10000, stratum=1.0, progress=None):
+    if method not in SAMPLING_METHODS:
+        raise ValueError(f"Unknown sampling method, expected one of {', '.join(SAMPLING_METHODS)}")
+    strata, packets, nbytes = _draw(records, method, every, size, stratum, random.Random(SAMPLING_SEED), progress)
+
+    strata = [(seen, kept) for _, (seen, kept, _, _) in sorted(strata.items()) if kept]
+    rows = sorted((index, h, record) for h, (_, kept) in enumerate(strata) for index, record in kept)
+    table = table_from_records(record for _, _, record in rows)
+    return Sample(method, table,
+                  np.array([h for _, h, _ in rows], dtype=np.int64),
+                  np.array([seen for seen, _ in strata], dtype=np.float64),
+                  np.array([len(kept) for _, kept in strata], dtype=np.float64),
+                  packets, nbytes)
+
+
+# Estimated top n protocols of a packet table column as a TopN scaled to the
+# capture's exact byte total, plus the lower and upper bounds of each
+# percentage's confidence interval
+def protocol_estimates(sample, column, n=10, z=CONFIDENCE_Z):
+    table = sample.table
+    x = table.lengths.astype(np.float64)
+    if len(x) == 0 or not x.any():
+        return TopN([], [], []), [], []
+    ids = table.packets[column]
+    scale = sample.population / sample.sampled
+    weights = scale[sample.strata]
+    estimated = np.bincount(ids, weights=weights * x, minlength=len(table.protocols))
+    top = top_n({table.protocols[pid]: float(estimated[pid]) for pid in np.flatnonzero(estimated)}, n)
+
+    # Group every packet under its top-n label, or "Other"
+    labels = top.labels
+    group_of = np.full(len(table.protocols), labels.index(OTHER_LABEL) if OTHER_LABEL in labels else 0)
+    for group, label in enumerate(labels):
+        if label != OTHER_LABEL:
+            group_of[table.protocols.index(label)] = group
+    groups = group_of[ids]
+
+    strata_count, group_count = len(scale), len(labels)
+    keys = sample.strata * group_count + groups
+    stratum_x = np.bincount(sample.strata, weights=x, minlength=strata_count)
+    stratum_x2 = np.bincount(sample.strata, weights=x * x, minlength=strata_count)
+    group_x = np.bincount(keys, weights=x, minlength=strata_count * group_count).reshape(strata_count, group_count)
+    group_x2 = np.bincount(keys, weights=x * x, minlength=strata_count * group_count).reshape(strata_count, group_count)
+    total = float(np.dot(scale, stratum_x))
+    shares = (scale @ group_x) / total
+
+    # Residuals d = y - p * x of the ratio estimate, summed per stratum
+    sum_d = group_x - shares * stratum_x[:, None]
+    sum_d2 = (1 - 2 * shares) * group_x2 + shares * shares * stratum_x2[:, None]
+    n_h = sample.sampled[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance_h = np.where(n_h > 1, (sum_d2 - sum_d * sum_d / n_h) / (n_h - 1), 0.0)
+    finite = (sample.population ** 2 * (1 - sample.sampled / sample.population) / sample.sampled)[:, None]
+    error = z * np.sqrt(np.sum(finite * np.maximum(variance_h, 0.0), axis=0)) / total
+
+    percentages = shares * 100
+    estimate = TopN(labels, (shares * sample.bytes).tolist(), percentages.tolist())
+    return (estimate,
+            np.clip(percentages - error * 100, 0, 100).tolist(),
+            np.clip(percentages + error * 100, 0, 100).tolist())
@@ -1,100 +1,784 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
 import os
-from werkzeug.utils import secure_filename
-from process_pcap import calculate_latency_and_bandwidth, generate_bandwidth_graph, generate_latency_graph, process_pcap, generate_transport_graph, generate_application_graph, generate_combined_graph
-import matplotlib
-
-matplotlib.use('Agg') # disable gui, fixes asynchronous issues
+os.environ.setdefault('MPLBACKEND', 'Agg') # disable gui, fixes asynchronous issues
+from flask import Flask, Request, Response, request, jsonify
+from flask_cors import CORS
+from werkzeug.formparser import FormDataParser, MultiPartParser
+import base64
+import gzip
+import hashlib
+import math
+import uuid
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from process_pcap import ENGINES, DEFAULT_ENGINE, GRAPH_KEYS, GRAPH_KINDS, cache_capture_graphs, cached_capture_graphs, capture_flows, capture_rtt, capture_series, capture_stack, chart_options, flow_query, generate_capture_data, generate_capture_preview, generate_capture_sketch, prepare_capture_graph, prepare_capture_graphs, register_table, result_kind, sampling_options, sketch_data
+from parallel_parse import CAPTURE_WORKERS
+from rollup import DEFAULT_ROLLUP_POINTS, MAX_ROLLUP_POINTS
+from sketches import CaptureSketch
+from render import image_mimetype, render_cache, submit_renders, warm_render_pool
+from result_cache import ResultCache, cache_key
+from stream_ingest import DiscardedUpload, UploadIngestor, keep_upload, unique_upload_path
+from jobs import HEARTBEAT_SECONDS, JOBS_DB, JobError, JobProgress, JobRunner, JobStore
+from captures import CAPTURES_DB, CaptureStore
+from warmup import warm_up
 
-app = Flask(__name__)
-CORS(app)
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pcap'}
 
+# Engines whose header decoding can run while the upload is still arriving
+STREAMING_ENGINES = {'native', 'mmap'}
+
+# When the engine is given in the query string (e.g.
+# /api/processPcap?engine=native) it is known before the body is read, so
+# uploads are hashed, parsed and saved in one pass as they stream in
+# Only the file fields the API reads are streamed to disk; any other file
+# part is dropped as it arrives
+UPLOAD_FIELDS = ('pcap', 'pcap1', 'pcap2')
+
+class IngestingMultiPartParser(MultiPartParser):
+    def start_file_streaming(self, event, total_content_length):
+        if event.name not in UPLOAD_FIELDS:
+            return DiscardedUpload()
+        return super().start_file_streaming(event, total_content_length)
+
+class IngestingFormDataParser(FormDataParser):
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        boundary = options.get('boundary', '').encode('ascii')
+        if not boundary:
+            raise ValueError("Missing boundary")
+        parser = IngestingMultiPartParser(stream_factory=self.stream_factory,
+                                          max_form_memory_size=self.max_form_memory_size,
+                                          max_form_parts=self.max_form_parts, cls=self.cls)
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
+
+class IngestingRequest(Request):
+    form_data_parser_class = IngestingFormDataParser
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Every upload streamed to disk for this request, see discard_uploads
+        self.ingestors = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.args.get('engine') in STREAMING_ENGINES:
+            ingestor = UploadIngestor(UPLOAD_FOLDER, filename)
+            self.ingestors.append(ingestor)
+            return ingestor
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app = Flask(__name__)
+app.request_class = IngestingRequest
+CORS(app)
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Captures are analysed and rendered in a bounded pool of CAPTURE_WORKERS
+# processes, shared by all requests
+capture_pool = None
+
+def get_capture_pool():
+    global capture_pool
+    if capture_pool is None:
+        capture_pool = ProcessPoolExecutor(max_workers=CAPTURE_WORKERS)
+    return capture_pool
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# "graphs" returns base64 PNGs, "data" returns the chart series as JSON for
+# the front end to render itself, "sketch" returns approximate summaries
+# computed in fixed memory (see sketches.py) and "preview" returns graphs and
+# estimates from a sample of the packets (see sampling.py). For graphs the
+# capture workers only prepare render tasks, which are then drawn in parallel
+# in the render pool.
+OUTPUT_FORMATS = {
+    'graphs': prepare_capture_graphs,
+    'data': generate_capture_data,
+    'sketch': generate_capture_sketch,
+    'preview': generate_capture_preview,
+}
+DEFAULT_OUTPUT_FORMAT = 'graphs'
+
+# How rendered graphs are delivered: "base64" embeds them in the JSON
+# response, "urls" returns a /api/graphs/<key> URL per graph instead, and
+# "multipart" returns every image as raw binary in one multipart/mixed body
+DELIVERY_MODES = ('base64', 'urls', 'multipart')
+DEFAULT_DELIVERY = 'base64'
+
+# Rendered graphs are addressed by their render key, which already covers
+# every input, so their URLs never change content and can be cached forever
+GRAPH_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Per-capture graph URLs depend on the server's chart code, so browsers
+# revalidate them with the ETag instead
+CAPTURE_GRAPH_CACHE_CONTROL = 'no-cache'
+
+# JSON and SVG responses are compressed with brotli (if installed) or gzip
+# when the client accepts it. PNG and WebP are already compressed.
+COMPRESSIBLE_MIMETYPES = {'application/json', 'image/svg+xml'}
+COMPRESS_MIN_BYTES = 1024
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/api/processPcap', methods=['POST'])
-def process_pcap_api():
-    print("Received a request to /api/processPcap")
+# Save an upload while computing its SHA-256, returning the hex digest
+def save_and_hash(file_storage, path):
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        while True:
+            chunk = file_storage.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+# Save an upload under its digest and return (path, digest). Uploads that
+# were parsed while streaming keep their packet table for the capture worker
+# to finish analysing.
+def store_upload(file_storage, engine):
+    folder = app.config['UPLOAD_FOLDER']
+    ingestor = file_storage.stream
+    if isinstance(ingestor, UploadIngestor):
+        table = ingestor.finish()
+        ingestor.close()
+        digest = ingestor.digest
+        path = keep_upload(folder, ingestor.path, digest)
+        if table is not None:
+            register_table(path, table, engine, digest)
+        elif ingestor.error:
+            print(f"Streaming parse of {file_storage.filename} failed: {ingestor.error}")
+        return path, digest
+
+    path = unique_upload_path(folder, file_storage.filename)
+    digest = save_and_hash(file_storage, path)
+    return keep_upload(folder, path, digest), digest
+
+# Delete every upload that was written to disk while streaming in and not
+# kept by store_upload (rejected requests, failures and repeated fields).
+# Runs after every request.
+@app.teardown_request
+def discard_uploads(error=None):
+    for ingestor in getattr(request, 'ingestors', ()):
+        ingestor.close()
+        if os.path.exists(ingestor.path):
+            os.remove(ingestor.path)
+
+def request_value(name, default=None):
+    return request.args.get(name) or request.form.get(name, default)
 
+def requested_output_format():
+    return request_value('format', DEFAULT_OUTPUT_FORMAT)
+
+def requested_delivery():
+    return request_value('delivery', DEFAULT_DELIVERY)
+
+# Chart options from the request; raises ValueError for invalid values
+def requested_options():
+    return chart_options({
+        'max_points': request_value('maxPoints'),
+        'downsample': request_value('downsample'),
+        'window': request_value('window'),
+        'smoothing': request_value('smoothing'),
+        'image_format': request_value('imageFormat'),
+        'dpi': request_value('dpi'),
+        'width': request_value('width'),
+        'height': request_value('height'),
+    })
+
+# Sampling options for previews from the request; raises ValueError for
+# invalid values
+def requested_sampling():
+    return sampling_options({
+        'method': request_value('sampling'),
+        'every': request_value('sampleEvery'),
+        'size': request_value('sampleSize'),
+        'stratum': request_value('stratum'),
+    })
+
+# True if a preview should be followed by a full run in the background
+def requested_full_run():
+    return request_value('full', '') in ('1', 'true')
+
+# Validate and store the pcap1/pcap2 uploads of a request. Returns
+# (engine, captures, None) with captures as [(name, path, digest), ...], or
+# (None, None, error_response) after discarding the uploads.
+def receive_uploads():
     if 'pcap1' not in request.files or 'pcap2' not in request.files:
         print("Error: No files provided")
-        return jsonify({"error": "No files provided"}), 400
+        return None, None, (jsonify({"error": "No files provided"}), 400)
 
     pcap1 = request.files['pcap1']
     pcap2 = request.files['pcap2']
 
     print(f"pcap1: {pcap1.filename}, pcap2: {pcap2.filename}")
 
-    if pcap1 and allowed_file(pcap1.filename) and pcap2 and allowed_file(pcap2.filename):
-        pcap1_filename = secure_filename(pcap1.filename)
-        pcap2_filename = secure_filename(pcap2.filename)
-        pcap1_path = os.path.join(app.config['UPLOAD_FOLDER'], pcap1_filename)
-        pcap2_path = os.path.join(app.config['UPLOAD_FOLDER'], pcap2_filename)
+    engine = request_value('engine', DEFAULT_ENGINE)
+    if engine not in ENGINES:
+        print(f"Error: Unknown engine {engine}")
+        return None, None, (jsonify({"error": f"Unknown engine, expected one of {', '.join(ENGINES)}"}), 400)
 
-        try:
-            pcap1.save(pcap1_path)
-            pcap2.save(pcap2_path)
-            print("Files saved successfully")
-        except Exception as e:
-            print(f"Error saving files: {e}")
-            return jsonify({"error": "Error saving files"}), 500
+    output_format = requested_output_format()
+    if output_format not in OUTPUT_FORMATS:
+        print(f"Error: Unknown format {output_format}")
+        return None, None, (jsonify({"error": f"Unknown format, expected one of {', '.join(OUTPUT_FORMATS)}"}), 400)
 
-        try:
-            df_app1, df_trans1 = process_pcap(pcap1_path)
-            df_app2, df_trans2 = process_pcap(pcap2_path)
+    delivery = requested_delivery()
+    if delivery not in DELIVERY_MODES:
+        print(f"Error: Unknown delivery {delivery}")
+        return None, None, (jsonify({"error": f"Unknown delivery, expected one of {', '.join(DELIVERY_MODES)}"}), 400)
+    if delivery == 'multipart' and output_format != 'graphs':
+        print(f"Error: Multipart delivery of format {output_format}")
+        return None, None, (jsonify({"error": "delivery=multipart is only supported for format=graphs"}), 400)
 
-            timestamps1, packet_sizes1 = calculate_latency_and_bandwidth(pcap1_path)
-            timestamps2, packet_sizes2 = calculate_latency_and_bandwidth(pcap2_path)
+    try:
+        requested_options()
+        requested_sampling()
+    except ValueError as e:
+        print(f"Error: Invalid options: {e}")
+        return None, None, (jsonify({"error": str(e)}), 400)
 
-            print("Pcap files processed successfully")
-        except Exception as e:
-            print(f"Error processing pcap files: {e}")
-            return jsonify({"error": "Error processing pcap files"}), 500
+    if not (pcap1 and allowed_file(pcap1.filename) and pcap2 and allowed_file(pcap2.filename)):
+        print("Error: Invalid file format")
+        return None, None, (jsonify({"error": "Invalid file format"}), 400)
 
-        try:
-            transport_graph1 = generate_transport_graph(df_trans1)
-            app_graph1 = generate_application_graph(df_app1)
-            mixed_graph1 = generate_combined_graph(df_app1, df_trans1)
+    try:
+        pcap1_path, digest1 = store_upload(pcap1, engine)
+        pcap2_path, digest2 = store_upload(pcap2, engine)
+        print("Files saved successfully")
+    except Exception as e:
+        print(f"Error saving files: {e}")
+        return None, None, (jsonify({"error": "Error saving files"}), 500)
 
-            transport_graph2 = generate_transport_graph(df_trans2)
-            app_graph2 = generate_application_graph(df_app2)
-            mixed_graph2 = generate_combined_graph(df_app2, df_trans2)
+    return engine, [('pcap1', pcap1_path, digest1), ('pcap2', pcap2_path, digest2)], None
 
-            latency_graph1 = generate_latency_graph(timestamps1)
-            latency_graph2 = generate_latency_graph(timestamps2)
-            bandwidth_graph1 = generate_bandwidth_graph(timestamps1, packet_sizes1)
-            bandwidth_graph2 = generate_bandwidth_graph(timestamps2, packet_sizes2)
+# Analyse every capture and render it in the requested output format,
+# returning {name: output}. For graphs each output is {key: (render key,
+# image bytes)}. Raises JobError naming the capture that failed.
+def analyse_captures(captures, engine, output_format=DEFAULT_OUTPUT_FORMAT, options=None, job_id=None, heartbeat=None,
+                     sampling=None):
+    generate = OUTPUT_FORMATS[output_format]
+    options = chart_options(options)
+    kind = result_kind(output_format, options)
+    if output_format == 'preview':
+        sampling = sampling_options(sampling)
+        generate = partial(generate, sampling=sampling)
+        kind = result_kind(output_format, dict(options, **sampling))
+    # Repeat uploads of a known capture skip parsing and rendering entirely
+    cache = ResultCache()
+    pool = get_capture_pool()
+    digests = {name: digest for name, _, digest in captures}
+    outputs = {}
+    futures = {}
+    for name, path, digest in captures:
+        if output_format == 'graphs':
+            cached = cached_capture_graphs(digest, engine, options)
+        else:
+            cached = cache.get(cache_key(digest, engine, kind))
+        if cached is not None:
+            print(f"{name}: cache hit for {digest}")
+            outputs[name] = cached
+            if job_id:
+                job_store.set_progress(job_id, name, 'done')
+        else:
+            progress = JobProgress(job_store.path, job_id, name) if job_id else None
+            futures[pool.submit(generate, path, engine, digest, progress, options)] = name
 
-            print("Graphs generated successfully")
-        except Exception as e:
-            print(f"Error generating graphs: {e}")
-            return jsonify({"error": "Error generating graphs"}), 500
-
-        results = {
-            "transportGraph1": transport_graph1,
-            "appGraph1": app_graph1,
-            "mixedGraph1": mixed_graph1,
-            "transportGraph2": transport_graph2,
-            "appGraph2": app_graph2,
-            "mixedGraph2": mixed_graph2,
-            "latencyGraph1": latency_graph1,
-            "latencyGraph2": latency_graph2,
-            "bandwidthGraph1": bandwidth_graph1,
-            "bandwidthGraph2": bandwidth_graph2
-        }
+    # Each finished graphs preparation fans out into one render per graph as
+    # soon as it finishes, so one capture renders while another still parses
+    renders = {}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = futures[future]
+            try:
+                output = future.result()
+            except Exception as e:
+                print(f"Error processing {name}: {e}")
+                if job_id:
+                    job_store.set_progress(job_id, name, 'failed')
+                for other in pending:
+                    other.cancel()
+                raise JobError(f"Error processing {name}")
+            if future in renders:
+                key, graph_key = renders.pop(future)
+                outputs[name][key] = (graph_key, output)
+                if not any(futures[other] == name for other in renders):
+                    cache_capture_graphs(outputs[name], engine, digests[name], options)
+                    if job_id:
+                        job_store.set_progress(job_id, name, 'done')
+            elif output_format == 'graphs':
+                outputs[name] = {}
+                for key, (graph_key, render) in submit_renders(output).items():
+                    futures[render] = name
+                    renders[render] = (key, graph_key)
+                    pending.add(render)
+                if not output:
+                    cache_capture_graphs(outputs[name], engine, digests[name], options)
+                    if job_id:
+                        job_store.set_progress(job_id, name, 'done')
+            else:
+                outputs[name] = output
+        if heartbeat is not None:
+            heartbeat()
+
+    return outputs
+
+def graph_url(graph_key):
+    return f"/api/graphs/{graph_key}"
+
+# Sketch summary of every capture, plus 'combined' for all of them merged
+def sketch_results(captures, outputs):
+    results = {name: sketch_data(outputs[name]) for name, _, _ in captures}
+    combined = CaptureSketch()
+    for name, _, _ in captures:
+        combined.merge(outputs[name])
+    results['combined'] = sketch_data(combined)
+    return results
+
+# Combine per-capture outputs into the JSON response body. Graphs are keyed
+# "<graph><index>" and given as base64 images or as URLs.
+def format_results(captures, outputs, output_format=DEFAULT_OUTPUT_FORMAT, delivery=DEFAULT_DELIVERY):
+    if output_format == 'data':
+        return {name: outputs[name] for name, _, _ in captures}
+    if output_format == 'sketch':
+        return sketch_results(captures, outputs)
+    if output_format == 'preview':
+        results = graph_results(captures, {name: outputs[name]['graphs'] for name, _, _ in captures}, delivery)
+        results['preview'] = {name: outputs[name]['estimates'] for name, _, _ in captures}
+        return results
+
+    return graph_results(captures, outputs, delivery)
 
+# Rendered graphs as "<graph><index>" keys, base64-encoded or as URLs
+def graph_results(captures, outputs, delivery=DEFAULT_DELIVERY):
+    results = {}
+    for index, (name, _, _) in enumerate(captures, start=1):
+        for key in GRAPH_KEYS:
+            graph_key, graph = outputs[name].get(key, (None, None))
+            if graph is None:
+                results[f"{key}{index}"] = None
+            elif delivery == 'urls':
+                results[f"{key}{index}"] = graph_url(graph_key)
+            else:
+                results[f"{key}{index}"] = base64.b64encode(graph).decode('utf-8')
+    return results
+
+# Every rendered graph as one part of a multipart/mixed response, named after
+# its "<graph><index>" key
+def multipart_graphs(captures, outputs):
+    boundary = uuid.uuid4().hex
+    body = []
+    for index, (name, _, _) in enumerate(captures, start=1):
+        for key in GRAPH_KEYS:
+            graph_key, graph = outputs[name].get(key, (None, None))
+            if graph is None:
+                continue
+            body.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: {image_mimetype(graph)}\r\n"
+                f"Content-Disposition: inline; name=\"{key}{index}\"\r\n"
+                f"Content-Location: {graph_url(graph_key)}\r\n"
+                f"ETag: \"{graph_key}\"\r\n"
+                f"Content-Length: {len(graph)}\r\n\r\n".encode('utf-8')
+            )
+            body.append(graph)
+            body.append(b"\r\n")
+    body.append(f"--{boundary}--\r\n".encode('utf-8'))
+    return Response(b''.join(body), mimetype=f"multipart/mixed; boundary={boundary}")
+
+def run_job(job_id, params, heartbeat):
+    captures = [tuple(capture) for capture in params['captures']]
+    output_format = params.get('format', DEFAULT_OUTPUT_FORMAT)
+    outputs = analyse_captures(captures, params['engine'], output_format, params.get('options'), job_id, heartbeat,
+                               params.get('sampling'))
+    return format_results(captures, outputs, output_format, params.get('delivery', DEFAULT_DELIVERY))
+
+# Jobs are queued in SQLite, so they survive restarts, and run by a small
+# pool of threads that feed the capture worker pool
+job_store = JobStore(JOBS_DB)
+job_runner = JobRunner(job_store, run_job)
+
+# Captures uploaded for lazily computed, per-graph access
+capture_store = CaptureStore(CAPTURES_DB)
+
+@app.route('/api/processPcap', methods=['POST'])
+def process_pcap_api():
+    print("Received a request to /api/processPcap")
+
+    engine, captures, error = receive_uploads()
+    if error:
+        return error
+
+    output_format = requested_output_format()
+    delivery = requested_delivery()
+    try:
+        outputs = analyse_captures(captures, engine, output_format, requested_options(),
+                                   sampling=requested_sampling())
+    except JobError as e:
+        return jsonify({"error": str(e)}), 500
+
+    print("Pcap files processed and graphs generated successfully")
+    if output_format == 'graphs' and delivery == 'multipart':
+        return multipart_graphs(captures, outputs)
+    results = format_results(captures, outputs, output_format, delivery)
+    # The uploads are already stored, so the full run starts straight away
+    # without uploading them again
+    if output_format == 'preview' and requested_full_run():
+        results['fullRun'] = queue_job({
+            'engine': engine,
+            'format': 'graphs',
+            'delivery': 'urls' if delivery == 'urls' else DEFAULT_DELIVERY,
+            'options': requested_options(),
+            'captures': captures,
+        })
+    if output_format == 'graphs' and results['appGraph1']:
         print(f"appGraph1 (first 50 chars): {results['appGraph1'][:50]}")
-        return jsonify(results)
+    return jsonify(results)
+
+# Queue the captures for background processing and return a job ID
+@app.route('/api/jobs', methods=['POST'])
+def submit_job_api():
+    print("Received a request to /api/jobs")
 
+    engine, captures, error = receive_uploads()
+    if error:
+        return error
+
+    delivery = requested_delivery()
+    if delivery == 'multipart':
+        return jsonify({"error": "Job results are JSON, use delivery=base64 or delivery=urls"}), 400
+
+    return jsonify(queue_job({
+        'engine': engine,
+        'format': requested_output_format(),
+        'delivery': delivery,
+        'options': requested_options(),
+        'sampling': requested_sampling(),
+        'captures': captures,
+    })), 202
+
+# Queue a job with the given parameters and return its ID and URLs
+def queue_job(params):
+    job_id = job_store.submit(params)
+    for name, _, _ in params['captures']:
+        job_store.set_progress(job_id, name, 'queued')
+    job_runner.start()
+    job_runner.notify()
+    print(f"Queued job {job_id}")
+    return {
+        "jobId": job_id,
+        "statusUrl": f"/api/jobs/{job_id}",
+        "resultsUrl": f"/api/jobs/{job_id}/results",
+    }
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status_api(job_id):
+    status = job_store.status(job_id)
+    if status is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(status)
+
+@app.route('/api/jobs/<job_id>/results', methods=['GET'])
+def job_results_api(job_id):
+    result = job_store.result(job_id)
+    if result is None:
+        return jsonify({"error": "Unknown job"}), 404
+    status, results, error = result
+    if status == 'failed':
+        return jsonify({"error": error}), 500
+    if status != 'done':
+        return jsonify({"status": status}), 202
+    return jsonify(results)
+
+# True if the client already holds the graph with this render key, in any
+# content encoding
+def client_has_graph(graph_key):
+    tags = request.if_none_match.as_set()
+    return '*' in tags or any(tag == graph_key or tag.startswith(f"{graph_key}-") for tag in tags)
+
+# Raw image response for a rendered graph, or a 304 when graph is None
+def graph_response(graph_key, graph, cache_control=GRAPH_CACHE_CONTROL):
+    if graph is None:
+        response = Response(status=304)
     else:
+        response = Response(graph, mimetype=image_mimetype(graph))
+    response.set_etag(graph_key)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+# A single rendered graph as raw image bytes. The render key is the ETag, so
+# a browser that already has the image gets a 304.
+@app.route('/api/graphs/<graph_key>', methods=['GET'])
+def graph_api(graph_key):
+    if len(graph_key) != 64 or any(c not in '0123456789abcdef' for c in graph_key):
+        return jsonify({"error": "Unknown graph"}), 404
+    if client_has_graph(graph_key):
+        return graph_response(graph_key, None)
+    graph = render_cache.get(graph_key)
+    if graph is None:
+        return jsonify({"error": "Unknown graph"}), 404
+    return graph_response(graph_key, graph)
+
+def capture_links(capture):
+    base = f"/api/captures/{capture['captureId']}"
+    return {
+        'captureId': capture['captureId'],
+        'filename': capture['filename'],
+        'digest': capture['digest'],
+        'engine': capture['engine'],
+        'graphs': {kind: f"{base}/graphs/{kind}" for kind in GRAPH_KINDS},
+        'dataUrl': f"{base}/data",
+        'stackUrl': f"{base}/stack",
+        'flowsUrl': f"{base}/flows",
+        'rttUrl': f"{base}/rtt",
+        'seriesUrl': f"{base}/series",
+    }
+
+# Store one uploaded capture ("pcap" field) without analysing it. Its graphs
+# are then computed one at a time, when first requested.
+@app.route('/api/captures', methods=['POST'])
+def create_capture_api():
+    print("Received a request to /api/captures")
+    if 'pcap' not in request.files:
+        print("Error: No file provided")
+        return jsonify({"error": "No file provided"}), 400
+    upload = request.files['pcap']
+
+    engine = request_value('engine', DEFAULT_ENGINE)
+    if engine not in ENGINES:
+        print(f"Error: Unknown engine {engine}")
+        return jsonify({"error": f"Unknown engine, expected one of {', '.join(ENGINES)}"}), 400
+
+    if not (upload and allowed_file(upload.filename)):
         print("Error: Invalid file format")
         return jsonify({"error": "Invalid file format"}), 400
 
+    try:
+        path, digest = store_upload(upload, engine)
+    except Exception as e:
+        print(f"Error saving file: {e}")
+        return jsonify({"error": "Error saving file"}), 500
+
+    capture_id = capture_store.add(upload.filename, path, digest, engine)
+    print(f"Stored capture {capture_id}")
+    return jsonify(capture_links(capture_store.get(capture_id))), 201
+
+@app.route('/api/captures/<capture_id>', methods=['GET'])
+def capture_api(capture_id):
+    capture = capture_store.get(capture_id)
+    if capture is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    return jsonify(capture_links(capture))
+
+# One graph of a capture, computed from its cached analysis and rendered on
+# first request, then served from the render cache. The render key for each
+# set of chart options is remembered, so repeat requests (and 304s) skip the
+# capture workers entirely.
+@app.route('/api/captures/<capture_id>/graphs/<kind>', methods=['GET'])
+def capture_graph_api(capture_id, kind):
+    capture = capture_store.get(capture_id)
+    if capture is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    if kind not in GRAPH_KINDS:
+        return jsonify({"error": f"Unknown graph, expected one of {', '.join(GRAPH_KINDS)}"}), 404
+    try:
+        options = requested_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    cache = ResultCache()
+    memo_key = cache_key(capture['digest'], capture['engine'], result_kind(f"graph-{kind}", options))
+    graph_key = cache.get(memo_key)
+    if graph_key and client_has_graph(graph_key):
+        return graph_response(graph_key, None, CAPTURE_GRAPH_CACHE_CONTROL)
+    graph = render_cache.get(graph_key) if graph_key else None
+
+    if graph is None:
+        try:
+            task = get_capture_pool().submit(prepare_capture_graph, capture['path'], capture['engine'],
+                                             capture['digest'], GRAPH_KINDS[kind], options).result()
+            if task is None:
+                return jsonify({"error": "Not enough packets for this graph"}), 404
+            graph_key, render = submit_renders({kind: task})[kind]
+            graph = render.result()
+        except Exception as e:
+            print(f"Error rendering {kind} graph of {capture_id}: {e}")
+            return jsonify({"error": "Error processing pcap file"}), 500
+        cache.put(memo_key, graph_key)
+
+    return graph_response(graph_key, graph, CAPTURE_GRAPH_CACHE_CONTROL)
+
+# Chart series of one capture, as returned by format=data
+@app.route('/api/captures/<capture_id>/data', methods=['GET'])
+def capture_data_api(capture_id):
+    capture = capture_store.get(capture_id)
+    if capture is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    try:
+        options = requested_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        outputs = analyse_captures([(capture_id, capture['path'], capture['digest'])], capture['engine'], 'data', options)
+    except JobError as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify(outputs[capture_id])
+
+# Drill-down into a capture's protocol stack. ?path=Ethernet/IPv4/TCP picks
+# a node (link layer first) and ?depth=N limits how many layers below it are
+# returned.
+@app.route('/api/captures/<capture_id>/stack', methods=['GET'])
+def capture_stack_api(capture_id):
+    capture = capture_store.get(capture_id)
+    if capture is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    path = tuple(name for name in request.args.get('path', '').split('/') if name)
+    depth = request.args.get('depth')
+    try:
+        depth = int(depth) if depth is not None else None
+    except ValueError:
+        return jsonify({"error": "depth must be an integer"}), 400
+    if depth is not None and depth < 0:
+        return jsonify({"error": "depth must not be negative"}), 400
+
+    try:
+        node = get_capture_pool().submit(capture_stack, capture['path'], capture['engine'],
+                                         capture['digest'], path, depth).result()
+    except Exception as e:
+        print(f"Error reading protocol stack of {capture_id}: {e}")
+        return jsonify({"error": "Error processing pcap file"}), 500
+    if node is None:
+        return jsonify({"error": "No packets with this protocol stack"}), 404
+    return jsonify(node)
+
+# Flow query options from the request; raises ValueError for invalid values
+def requested_flow_query():
+    return flow_query({
+        'idle_timeout': request_value('idleTimeout'),
+        'sort': request_value('sort'),
+        'limit': request_value('limit'),
+    })
+
+# Per-flow bandwidth, duration and inter-arrival statistics of a capture.
+# ?src=&sport=&dst=&dport=&transport= looks up the flows of one 5-tuple (in
+# either direction) instead of listing the largest.
+@app.route('/api/captures/<capture_id>/flows', methods=['GET'])
+def capture_flows_api(capture_id):
+    capture = capture_store.get(capture_id)
+    if capture is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    try:
+        query = requested_flow_query()
+        endpoints = None
+        if 'src' in request.args or 'dst' in request.args:
+            endpoints = (request.args['src'], int(request.args.get('sport', 0)),
+                         request.args['dst'], int(request.args.get('dport', 0)),
+                         request.args.get('transport', 'TCP'))
+    except KeyError:
+        return jsonify({"error": "src and dst must be given together"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        flows = get_capture_pool().submit(capture_flows, capture['path'], capture['engine'],
+                                          capture['digest'], query, endpoints).result()
+    except Exception as e:
+        print(f"Error computing flows of {capture_id}: {e}")
+        return jsonify({"error": "Error processing pcap file"}), 500
+    return jsonify(flows)
+
+# Round-trip time distributions of a capture, per kind of sample (TCP
+# handshake, TCP data, DNS, ICMP echo) and for the ?limit= flows with the
+# most samples
+@app.route('/api/captures/<capture_id>/rtt', methods=['GET'])
+def capture_rtt_api(capture_id):
+    capture = capture_store.get(capture_id)
+    if capture is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    try:
+        limit = flow_query({'limit': request_value('limit')})['limit']
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        rtt = get_capture_pool().submit(capture_rtt, capture['path'], capture['engine'],
+                                        capture['digest'], limit).result()
+    except Exception as e:
+        print(f"Error computing round-trip times of {capture_id}: {e}")
+        return jsonify({"error": "Error processing pcap file"}), 500
+    return jsonify(rtt)
+
+# Zoomable time series of a capture: bytes, packets and top protocols per
+# bucket between ?start= and ?end= (seconds from the first packet), read from
+# the finest rollup tier that fits the range in ?maxPoints= buckets
+@app.route('/api/captures/<capture_id>/series', methods=['GET'])
+def capture_series_api(capture_id):
+    capture = capture_store.get(capture_id)
+    if capture is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    try:
+        start = float(request.args['start']) if 'start' in request.args else None
+        end = float(request.args['end']) if 'end' in request.args else None
+        max_points = int(request.args.get('maxPoints', DEFAULT_ROLLUP_POINTS))
+        if not 1 <= max_points <= MAX_ROLLUP_POINTS:
+            raise ValueError(f"maxPoints must be between 1 and {MAX_ROLLUP_POINTS}")
+        if any(value is not None and not math.isfinite(value) for value in (start, end)):
+            raise ValueError("start and end must be finite")
+        if start is not None and end is not None and end < start:
+            raise ValueError("end must not be before start")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        series = get_capture_pool().submit(capture_series, capture['path'], capture['engine'],
+                                           capture['digest'], start, end, max_points).result()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error reading time series of {capture_id}: {e}")
+        return jsonify({"error": "Error processing pcap file"}), 500
+    return jsonify(series)
+
+# Content encoding to use for this request's response, if any
+def negotiated_encoding():
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(encodings)
+
+@app.after_request
+def compress_response(response):
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.status_code != 200
+            or response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiated_encoding()
+    if encoding is None:
+        return response
+    response.set_data(brotli.compress(data) if encoding == 'br' else gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    # Each encoding of the same content gets its own strong ETag
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5001)
\ No newline at end of file
+    debug = True
+    # With the debug reloader this block also runs in the parent process,
+    # which only watches for changes; requests are served by a child process
+    # started with WERKZEUG_RUN_MAIN set, so only that one is warmed up
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up()
+        warm_render_pool()
+        job_runner.start()
+    app.run(debug=debug, host="0.0.0.0", port=5001)
@@ -0,0 +1,145 @@
+import json
+import os
+import struct
+import tempfile
+import numpy as np
+from packet_table import PacketTable, PACKET_DTYPE
+
+# Summary sidecar written next to an analysed capture.
+#
+# Layout (little endian):
+#   magic 'PVSC' | u16 version | u16 reserved | u32 header length | 32 byte digest
+#   JSON header (protocol/address names, totals, source info, array index)
+#   arrays, starting at the first ARRAY_ALIGNMENT boundary after the header,
+#   each aligned and described in the header by name, dtype descr, shape and
+#   offset from the start of the array section
+#
+# Arrays are memory-mapped on load, so reading a sidecar costs little more
+# than parsing its header regardless of the number of packets.
+
+SIDECAR_MAGIC = b'PVSC'
+SIDECAR_VERSION = 6
+SIDECAR_SUFFIX = '.pvsum'
+ARRAY_ALIGNMENT = 64
+
+_preamble = struct.Struct('<4sHHI32s')
+
+
+class SidecarError(ValueError):
+    pass
+
+
+# Each engine decodes a capture differently, so each gets its own sidecar
+def sidecar_path(pcap_file, engine):
+    return f"{pcap_file}.{engine}{SIDECAR_SUFFIX}"
+
+
+# Size and modification time identify the capture a sidecar was built from
+# without re-hashing it
+def source_info(pcap_file):
+    stat = os.stat(pcap_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _align(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+# Write `table` plus any extra named arrays and metadata to `path`. The
+# digest is the capture's SHA-256 hex digest, if known.
+def write_sidecar(path, table, digest, engine, totals, source=None, arrays=None, meta=None):
+    arrays = dict(arrays or {})
+    arrays['packets'] = table.packets
+
+    header = {
+        'engine': engine,
+        'protocols': table.protocols,
+        'addresses': table.addresses,
+        'totals': totals,
+        'source': source,
+        'meta': meta or {},
+        'arrays': [],
+    }
+
+    names = list(arrays)
+    offset = 0
+    for name in names:
+        array = np.ascontiguousarray(arrays[name])
+        header['arrays'].append({
+            'name': name,
+            'dtype': np.lib.format.dtype_to_descr(array.dtype),
+            'shape': list(array.shape),
+            'offset': offset,
+        })
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(_preamble.size + len(header_bytes))
+
+    folder = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_preamble.pack(SIDECAR_MAGIC, SIDECAR_VERSION, 0, len(header_bytes), bytes.fromhex(digest) if digest else bytes(32)))
+            f.write(header_bytes)
+            for entry, name in zip(header['arrays'], names):
+                f.write(b'\0' * (data_start + entry['offset'] - f.tell()))
+                f.write(np.ascontiguousarray(arrays[name]).tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Load a sidecar, memory-mapping its arrays. Returns a dict with 'table',
+# 'digest', 'engine', 'totals', 'source', 'meta' and 'arrays'.
+def read_sidecar(path):
+    with open(path, 'rb') as f:
+        preamble = f.read(_preamble.size)
+        if len(preamble) < _preamble.size:
+            raise SidecarError("Truncated sidecar")
+        magic, version, _, header_len, digest = _preamble.unpack(preamble)
+        if magic != SIDECAR_MAGIC:
+            raise SidecarError("Not a sidecar file")
+        if version != SIDECAR_VERSION:
+            raise SidecarError(f"Unsupported sidecar version {version}")
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = _align(_preamble.size + header_len)
+
+    arrays = {}
+    for entry in header['arrays']:
+        dtype = np.lib.format.descr_to_dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[entry['name']] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[entry['name']] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + entry['offset'], shape=shape)
+
+    packets = arrays.pop('packets')
+    if packets.dtype != PACKET_DTYPE:
+        raise SidecarError("Sidecar packet layout does not match this version")
+
+    return {
+        'table': PacketTable(packets, header['protocols'], header['addresses']),
+        'digest': digest.hex() if any(digest) else None,
+        'engine': header['engine'],
+        'totals': header['totals'],
+        'source': header['source'],
+        'meta': header['meta'],
+        'arrays': arrays,
+    }
+
+
+# Sidecar next to pcap_file if it exists and still matches the capture
+def find_sidecar(pcap_file, engine):
+    path = sidecar_path(pcap_file, engine)
+    if not os.path.exists(path):
+        return None
+    try:
+        sidecar = read_sidecar(path)
+    except (SidecarError, ValueError, OSError):
+        return None
+    if sidecar['engine'] != engine or sidecar['source'] != source_info(pcap_file):
+        return None
+    return sidecar
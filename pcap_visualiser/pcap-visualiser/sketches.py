@@ -0,0 +1,289 @@
+import hashlib
+import heapq
+from itertools import islice
+import numpy as np
+from packet_table import PacketTableBuilder
+from topk import OTHER_LABEL, TopN
+
+# Fixed-memory streaming summaries for captures too large to hold as a
+# packet table. Records are decoded in batches of SKETCH_BATCH packets; each
+# batch updates the sketches below and is then thrown away. Every sketch is
+# mergeable, so chunks parsed in parallel (and separate captures) combine
+# into the same result as one sequential pass.
+#
+# Error bounds:
+# HyperLogLog   distinct counts have a relative standard error of
+#               1.04 / sqrt(2 ** HLL_PRECISION), about 0.8%.
+# Count-Min     per-label byte counts never undercount and overcount by at
+#               most e / CMS_WIDTH of all bytes (0.1%) with probability
+#               1 - exp(-CMS_DEPTH) (99.3%).
+# t-digest      percentiles are typically within 0.5% in rank, and more
+#               accurate towards the tails; the minimum and maximum are exact.
+
+SKETCH_BATCH = 65536
+
+HLL_PRECISION = 14
+CMS_WIDTH = 2719
+CMS_DEPTH = 5
+HEAVY_HITTER_CAPACITY = 64
+TDIGEST_COMPRESSION = 200
+
+
+def _mix(values):
+    # splitmix64 finaliser over uint64 arrays (wrapping arithmetic)
+    x = np.asarray(values, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# Stable 64-bit hashes of names (addresses, protocols), the same in every
+# process and batch
+def hash_names(names):
+    return np.array([int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+                     for name in names], dtype=np.uint64)
+
+
+class HyperLogLog:
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # frexp's exponent is the bit length (0 for 0); exact below 2 ** 53
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        np.maximum.at(self.registers, index, (bits - bit_length + 1).astype(np.uint8))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+
+_CMS_SEEDS = _mix(np.arange(1, 65, dtype=np.uint64))
+
+
+class CountMinSketch:
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.uint64)
+
+    def _columns(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        return [(_mix(hashes ^ seed) % np.uint64(self.width)).astype(np.int64)
+                for seed in _CMS_SEEDS[:len(self.table)]]
+
+    def add(self, hashes, counts):
+        counts = np.asarray(counts, dtype=np.uint64)
+        for row, columns in zip(self.table, self._columns(hashes)):
+            np.add.at(row, columns, counts)
+
+    def query(self, hashes):
+        return np.min([row[columns] for row, columns in zip(self.table, self._columns(hashes))], axis=0)
+
+    def merge(self, other):
+        self.table += other.table
+
+
+# Top labels by weight: a Count-Min sketch estimates every label's total and
+# the best `capacity` candidates seen so far are kept by label
+class HeavyHitters:
+    def __init__(self, capacity=HEAVY_HITTER_CAPACITY):
+        self.capacity = capacity
+        self.counts = CountMinSketch()
+        self.candidates = {}
+
+    # Add the total weight of each distinct label in a batch
+    def add(self, labels, hashes, weights):
+        if len(labels) == 0:
+            return
+        self.counts.add(hashes, weights)
+        self.candidates.update(zip(labels, hashes.tolist()))
+        if len(self.candidates) > self.capacity:
+            self.candidates = dict(self._ranked(self.capacity))
+
+    def _ranked(self, n):
+        labels = list(self.candidates)
+        estimates = self.counts.query(np.array([self.candidates[label] for label in labels], dtype=np.uint64))
+        top = heapq.nlargest(n, zip(estimates.tolist(), labels))
+        return [(label, self.candidates[label]) for _, label in top]
+
+    # [(label, estimated weight)] of the n heaviest labels, largest first
+    def top(self, n):
+        if not self.candidates:
+            return []
+        ranked = self._ranked(n)
+        estimates = self.counts.query(np.array([h for _, h in ranked], dtype=np.uint64))
+        return [(label, int(estimate)) for (label, _), estimate in zip(ranked, estimates.tolist())]
+
+    def merge(self, other):
+        self.counts.merge(other.counts)
+        self.candidates.update(other.candidates)
+        if len(self.candidates) > self.capacity:
+            self.candidates = dict(self._ranked(self.capacity))
+
+
+# Merging t-digest with the k1 (arcsine) scale function: values are kept as
+# weighted centroids, small near the extremes and larger in the middle
+class TDigest:
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def add(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._compress(np.concatenate((self.means, values)), np.concatenate((self.weights, weights)))
+
+    # Sort all centroids and values and merge neighbours whose quantiles fall
+    # in the same unit of the scale function
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        before = np.cumsum(weights) - weights
+        q = before / weights.sum()
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)).astype(np.int64)
+        groups = k - k[0]
+        count = int(groups[-1]) + 1
+        totals = np.bincount(groups, weights=weights, minlength=count)
+        sums = np.bincount(groups, weights=weights * means, minlength=count)
+        present = totals > 0
+        self.weights = totals[present]
+        self.means = sums[present] / self.weights
+
+    def merge(self, other):
+        if len(other.means):
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._compress(np.concatenate((self.means, other.means)), np.concatenate((self.weights, other.weights)))
+
+    # Estimated value at quantile q (0..1), or None if nothing was added
+    def quantile(self, q):
+        total = self.count
+        if total == 0:
+            return None
+        mids = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * total, np.concatenate(([0.0], mids, [total])),
+                               np.concatenate(([self.min], self.means, [self.max]))))
+
+    def mean(self):
+        total = self.count
+        return float(np.dot(self.means, self.weights) / total) if total else None
+
+
+# Every sketch kept for one capture, plus exact packet/byte counts and time
+# range
+class CaptureSketch:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.hosts = HyperLogLog()
+        self.flows = HyperLogLog()
+        self.talkers = HeavyHitters()
+        self.applications = HeavyHitters()
+        self.transports = HeavyHitters()
+        self.sizes = TDigest()
+        self.gaps = TDigest()
+
+    def _add_totals(self, hitters, ids, names, hashes, lengths):
+        totals = np.bincount(ids, weights=lengths, minlength=len(names))
+        present = np.flatnonzero(totals)
+        present = present[present != 0]
+        hitters.add([names[i] for i in present.tolist()], hashes[present], totals[present])
+
+    # Update every sketch from one batch of packets
+    def add_table(self, table):
+        packets = table.packets
+        if len(packets) == 0:
+            return
+        timestamps = packets['timestamp']
+        lengths = packets['length'].astype(np.float64)
+        self.packets += len(packets)
+        self.bytes += int(packets['length'].sum(dtype=np.int64))
+        if self.last is not None:
+            gaps = np.diff(timestamps, prepend=self.last)
+        else:
+            gaps = np.diff(timestamps)
+        self.first = float(timestamps.min()) if self.first is None else min(self.first, float(timestamps.min()))
+        self.last = float(timestamps[-1])
+        self.sizes.add(lengths)
+        self.gaps.add(np.maximum(gaps, 0.0))
+
+        address_hashes = hash_names(table.addresses)
+        protocol_hashes = hash_names(table.protocols)
+        src, dst = packets['src'], packets['dst']
+        hosts = np.unique(np.concatenate((src, dst)))
+        self.hosts.add(address_hashes[hosts[hosts != 0]])
+
+        ip = (src != 0) & (dst != 0)
+        a = _mix(address_hashes[src[ip]] ^ packets['sport'][ip].astype(np.uint64))
+        b = _mix(address_hashes[dst[ip]] ^ packets['dport'][ip].astype(np.uint64))
+        flow_hashes = _mix(np.minimum(a, b) ^ _mix(np.maximum(a, b) ^ protocol_hashes[packets['transport'][ip]]))
+        self.flows.add(np.unique(flow_hashes))
+
+        self._add_totals(self.talkers, src, table.addresses, address_hashes, lengths)
+        self._add_totals(self.applications, packets['application'], table.protocols, protocol_hashes, lengths)
+        self._add_totals(self.transports, packets['transport'], table.protocols, protocol_hashes, lengths)
+
+    def merge(self, other):
+        if other.packets == 0:
+            return
+        self.packets += other.packets
+        self.bytes += other.bytes
+        self.first = other.first if self.first is None else min(self.first, other.first)
+        self.last = other.last if self.last is None else max(self.last, other.last)
+        for name in ('hosts', 'flows', 'talkers', 'applications', 'transports', 'sizes', 'gaps'):
+            getattr(self, name).merge(getattr(other, name))
+
+    # Top n labels of `hitters` as a TopN, with whatever they leave of the
+    # exact byte total as "Other"
+    def top(self, hitters, n):
+        top = hitters.top(n)
+        labels = [label for label, _ in top]
+        values = [value for _, value in top]
+        rest = self.bytes - sum(values)
+        if rest > 0:
+            labels.append(OTHER_LABEL)
+            values.append(rest)
+        total = max(self.bytes, sum(values))
+        return TopN(labels, values, [value / total * 100 if total else 0.0 for value in values])
+
+
+# Sketch (timestamp, caplen, wirelen, linktype, buf, offset) records from
+# pcap_reader in batches of SKETCH_BATCH packets
+def sketch_records(records, progress=None):
+    sketch = CaptureSketch()
+    records = iter(records)
+    while True:
+        builder = PacketTableBuilder()
+        builder.add_records(islice(records, SKETCH_BATCH))
+        if len(builder) == 0:
+            return sketch
+        sketch.add_table(builder.build())
+        if progress is not None:
+            progress('parsing', sketch.packets)
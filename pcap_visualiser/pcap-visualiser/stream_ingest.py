@@ -0,0 +1,110 @@
+import hashlib
+import io
+import os
+import struct
+import tempfile
+from werkzeug.utils import secure_filename
+from pcap_reader import PcapFormatError, RecordWalker
+from packet_table import PacketTableBuilder
+
+
+# Unique path in `folder` for an upload, so concurrent uploads that share a
+# filename never overwrite each other
+def unique_upload_path(folder, filename):
+    fd, path = tempfile.mkstemp(dir=folder, suffix='-' + (secure_filename(filename or '') or 'upload.pcap'))
+    os.close(fd)
+    return path
+
+
+# Move a saved upload to the path named after its SHA-256 digest in
+# `folder` and return that path. A repeat upload of a stored capture is
+# deleted instead, so it reuses the stored file and its sidecar and the
+# folder only grows with distinct captures.
+def keep_upload(folder, path, digest):
+    stored = os.path.join(folder, f"{digest}.pcap")
+    try:
+        os.link(path, stored)
+    except FileExistsError:
+        pass
+    os.remove(path)
+    return stored
+
+
+# Stand-in for an upload part nobody reads: its bytes are dropped as they
+# arrive instead of being written anywhere
+class DiscardedUpload(io.BytesIO):
+    def write(self, data):
+        return len(data)
+
+
+# Writable file object handed to werkzeug's multipart parser for an upload.
+# Every chunk of the request body is hashed, teed to disk and fed to the
+# native record parser as it arrives, so the packet table is ready by the
+# time the upload completes.
+class UploadIngestor:
+    def __init__(self, folder, filename, parse=True):
+        self.path = unique_upload_path(folder, filename)
+        self.error = None
+        self._file = open(self.path, 'w+b')
+        self._digest = hashlib.sha256()
+        self._parse = parse
+        self._walker = RecordWalker()
+        self._buf = bytearray()
+        self._builder = PacketTableBuilder()
+
+    def write(self, data):
+        self._digest.update(data)
+        self._file.write(data)
+        if self._parse:
+            self._buf += data
+            try:
+                self._builder.add_records(
+                    (timestamp, caplen, wirelen, linktype, self._buf, offset)
+                    for timestamp, caplen, wirelen, linktype, offset in self._walker.walk(self._buf)
+                )
+            except (PcapFormatError, IndexError, struct.error) as e:
+                # Keep saving the upload; it will be analysed from disk instead
+                self.error = str(e)
+                self._parse = False
+                self._buf = bytearray()
+                return len(data)
+            del self._buf[:self._walker.offset]
+        return len(data)
+
+    @property
+    def packets_parsed(self):
+        return len(self._builder)
+
+    @property
+    def digest(self):
+        return self._digest.hexdigest()
+
+    # Packet table for the upload, or None if it could not be parsed while
+    # streaming (not a capture, or parsing was disabled)
+    def finish(self):
+        self._file.flush()
+        if not self._parse or self._walker.format is None:
+            return None
+        return self._builder.build()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
@@ -0,0 +1,87 @@
+import numpy as np
+
+# Windowed throughput: bytes and packets are binned into fixed time windows
+# with bincount, instead of dividing each packet by the gap to its
+# predecessor, which is mostly noise at microsecond gaps.
+
+MIN_WINDOW = 0.001
+MAX_WINDOW = 60.0
+
+# With an automatic window, aim for about this many windows per capture
+TARGET_WINDOWS = 500
+
+DEFAULT_PERCENTILES = (50, 95, 99)
+
+# A requested window is widened until the capture fits in this many windows,
+# so a 1 ms window over a day-long capture cannot allocate 86M bins
+MAX_WINDOWS = 100000
+
+
+# Window size giving roughly target windows over `duration`, rounded to a
+# 1/2/5 step and clamped to [MIN_WINDOW, MAX_WINDOW]
+def choose_window(duration, target=TARGET_WINDOWS):
+    if duration <= 0:
+        return MIN_WINDOW
+    raw = duration / target
+    magnitude = 10.0 ** np.floor(np.log10(raw))
+    for step in (1, 2, 5, 10):
+        window = step * magnitude
+        if window >= raw:
+            break
+    return float(min(MAX_WINDOW, max(MIN_WINDOW, window)))
+
+
+# Centred moving average over `span` windows, same length as values
+def moving_average(values, span):
+    values = np.asarray(values, dtype=np.float64)
+    if span <= 1 or len(values) == 0:
+        return values.copy()
+    span = min(span, len(values))
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    half = span // 2
+    ends = np.minimum(np.arange(len(values)) + span - half, len(values))
+    starts = np.maximum(np.arange(len(values)) - half, 0)
+    return (cumulative[ends] - cumulative[starts]) / (ends - starts)
+
+
+# Bin packets into windows of `window` seconds ('auto' or None picks one),
+# widened if needed to keep within MAX_WINDOWS windows. Returns a dict with
+# the window size, window start times and per-window byte/packet counts and
+# rates.
+def bin_throughput(timestamps, sizes, window=None):
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    sizes = np.asarray(sizes, dtype=np.float64)
+    if len(timestamps) == 0:
+        empty = np.empty(0)
+        return {'window': MIN_WINDOW, 'start': 0.0, 'times': empty, 'bytes': empty,
+                'packets': empty, 'bytes_per_second': empty, 'packets_per_second': empty}
+
+    start = float(timestamps.min())
+    duration = float(timestamps.max()) - start
+    if window in (None, 'auto'):
+        window = choose_window(duration)
+    window = float(min(MAX_WINDOW, max(MIN_WINDOW, window)))
+    window = max(window, duration / (MAX_WINDOWS - 1))
+
+    bins = ((timestamps - start) / window).astype(np.int64)
+    count = int(bins.max()) + 1
+    window_bytes = np.bincount(bins, weights=sizes, minlength=count)
+    window_packets = np.bincount(bins, minlength=count).astype(np.float64)
+
+    return {
+        'window': window,
+        'start': start,
+        'times': start + np.arange(count) * window,
+        'bytes': window_bytes,
+        'packets': window_packets,
+        'bytes_per_second': window_bytes / window,
+        'packets_per_second': window_packets / window,
+    }
+
+
+# Percentiles of a per-window rate, e.g. {'p50': ..., 'p95': ...}
+def window_percentiles(values, percentiles=DEFAULT_PERCENTILES):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {f"p{p}": None for p in percentiles}
+    return {f"p{p}": float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))}
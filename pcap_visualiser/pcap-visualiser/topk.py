@@ -0,0 +1,32 @@
+import heapq
+from collections import namedtuple
+
+# Top-N breakdown of a {label: total} mapping, largest first, with everything
+# past the first n folded into a single "Other" entry. Plain tuples and
+# lists, so it is cheap to build, pickle and hash.
+TopN = namedtuple('TopN', ['labels', 'values', 'percentages'])
+
+OTHER_LABEL = 'Other'
+
+
+def _percentages(values, total):
+    if not total:
+        return [0.0] * len(values)
+    return [value / total * 100 for value in values]
+
+
+# Top n of a {label: total} dict. Sorting only happens on the n largest
+# entries: heapq.nlargest keeps a heap of size n over the items.
+def top_n(totals, n):
+    total = sum(totals.values())
+    if len(totals) > n:
+        top = heapq.nlargest(n, totals.items(), key=lambda item: item[1])
+        labels = [label for label, _ in top] + [OTHER_LABEL]
+        values = [value for _, value in top]
+        values.append(total - sum(values))
+    else:
+        top = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+        labels = [label for label, _ in top]
+        values = [value for _, value in top]
+    return TopN(labels, values, _percentages(values, total))
+
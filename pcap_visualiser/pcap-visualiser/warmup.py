@@ -0,0 +1,47 @@
+import gc
+import time
+
+# Everything the server defers until first use, loaded up front. Run it once
+# in the process that later forks the workers (e.g. gunicorn's master with
+# preload_app) so every worker inherits the loaded modules and font cache
+# copy-on-write instead of paying for them on its first request.
+
+
+# tshark binary pyshark will run and its version, or raise if it is missing
+def check_tshark():
+    from pyshark.tshark.tshark import get_process_path, get_tshark_version
+    path = get_process_path()
+    return path, str(get_tshark_version(path))
+
+
+# Import the heavy dependencies, build the matplotlib font cache and check
+# tshark. A missing tshark is reported but not fatal, since the native and
+# mmap engines do not need it. Returns {step: seconds or error}.
+def warm_up(freeze=False):
+    report = {}
+
+    start = time.perf_counter()
+    import numpy  # noqa: F401
+    import pandas  # noqa: F401
+    import pyshark  # noqa: F401
+    report['imports'] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    from render import warm_renderer
+    warm_renderer()
+    report['fonts'] = round(time.perf_counter() - start, 3)
+
+    try:
+        path, version = check_tshark()
+        report['tshark'] = f"{path} {version}"
+    except Exception as e:
+        report['tshark'] = f"unavailable: {e}"
+        print(f"Warning: tshark not usable, the pyshark engine will fail: {e}")
+
+    # Move everything loaded so far out of the garbage collector's reach, so
+    # collections in forked workers do not touch (and copy) those pages
+    if freeze:
+        gc.freeze()
+
+    print(f"Warm-up done: {report}")
+    return report
@@ -1,56 +1,32 @@
-from collections import defaultdict
-import pyshark
+import os
+import sys
 import pandas as pd
 import matplotlib.pyplot as plt
-import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pcap_visualiser', 'pcap-visualiser'))
+from process_pcap import analyse_pcap
+from flows import build_flows
 
 PCAP_FILE_BEFORE = 'before_mud.pcap'
 PCAP_FILE_AFTER = 'after_mud.pcap'
 
 # Function to extract bandwidth and latency data from a pcap files
 def extract_traffic_stats(pcap_file):
-    cap = pyshark.FileCapture(pcap_file, keep_packets=False)
-    flow_data = defaultdict(lambda: {'timestamps': [], 'bytes': 0})
-
     print(f"Processing {pcap_file} for traffic stats...")
-    
-    for packet in cap:
-        try:
-            if 'IP' in packet:
-                # Extract details
-                src_ip = packet.ip.src
-                dst_ip = packet.ip.dst
-                timestamp = float(packet.sniff_time.timestamp())
-                size = int(packet.length)
-                
-                # Unique flow identification by source/destination IP
-                flow_key = (src_ip, dst_ip)
-                
-                # Store the timestamp and packet size for this flow
-                flow_data[flow_key]['timestamps'].append(timestamp)
-                flow_data[flow_key]['bytes'] += size
-        except AttributeError:
-            continue
+    table = analyse_pcap(pcap_file)['table']
 
-    # Convert flow data into a DataFrame with per/sec bandwidth and latency
+    # Flows by 5-tuple, both directions together
     time_series = []
-    for flow_key, data in flow_data.items():
-        timestamps = data['timestamps']
-        bytes_transferred = data['bytes']
-        
-        # Bandwidth: Sum bytes per second
-        start_time = min(timestamps)
-        end_time = max(timestamps)
-        
+    for flow in build_flows(table).records(sort='first'):
+        flow_key = (flow['src'], flow['sport'], flow['dst'], flow['dport'], flow['transport'])
         # Calculate bandwidth for this flow (bytes per second)
-        duration = end_time - start_time if end_time != start_time else 1
-        bandwidth = bytes_transferred / duration
-        
+        bandwidth = flow['bandwidth'] if flow['bandwidth'] is not None else flow['bytes']
+
         # Latency: Difference between first and last timestamp
-        latency = max(timestamps) - min(timestamps)
-        
-        time_series.append({'flow_key': flow_key, 'bandwidth': bandwidth, 'latency': latency, 'timestamps': (start_time, end_time)})
-    
+        latency = flow['duration']
+
+        time_series.append({'flow_key': flow_key, 'bandwidth': bandwidth, 'latency': latency, 'timestamps': (flow['start'], flow['end'])})
+
     df = pd.DataFrame(time_series)
     return df
 